@@ -17,14 +17,30 @@ record matching user provided regex string
 5/10/2019 - added retro support and python3 - apeacock@cisco.com
 """
 
-import logging, re, json, time
+import logging, re, json, time, itertools, sys, os, struct, array, mmap
+import hashlib, heapq, calendar, collections, shlex, bisect
+import gzip, io, stat
 import xml.etree.ElementTree as ET
 
-# override sort with natsort if available
-try:    
-    from natsort import natsorted as sorted
-except: pass
-    
+# resource is used for peak memory stats when available (unix only)
+try:
+    import resource
+except ImportError: resource = None
+# regex parser used to find the literals a pattern requires, re._parser
+# since python 3.11
+try:
+    import re._parser as sre_parse
+except ImportError:
+    import sre_parse
+# bz2 and xz decompression depend on optional libraries python may be 
+# built without
+try:
+    import bz2
+except ImportError: bz2 = None
+try:
+    import lzma
+except ImportError: lzma = None
+
 
 def td(start, end, milli=True):
     """
@@ -36,116 +52,1348 @@ def td(start, end, milli=True):
     else: s = "{0:.3f} secs".format(delta)
     return s
 
-def dump_entries(entries):
+class Stats(object):
+    """
+    instrumentation for --stats.  Records per-phase wall time, cpu time and
+    peak memory (process peak RSS when the phase was last exited) along
+    with named counters.  Phase time is exclusive: while entries stream 
+    through several phases (ex: build -> search -> output) each phase is
+    only charged for its own time.  Nothing is recorded unless enabled
+    """
+    def __init__(self):
+        self.enabled = False
+        self.phases = {}
+        self.counters = {}
+        self.stack = []
+        self.mark = None
+        self.start = (time.perf_counter(), time.process_time())
+
+    def count(self, name, n=1):
+        """ increment counter name by n """
+        if self.enabled: self.counters[name] = self.counters.get(name, 0) + n
+
+    def enter(self, name):
+        """ start phase name, pausing the currently running phase """
+        if not self.enabled: return
+        now = (time.perf_counter(), time.process_time())
+        if len(self.stack) > 0: self._charge(self.stack[-1], now)
+        self.stack.append(name)
+        self.mark = now
+
+    def exit(self, sample=True):
+        """ end the current phase and resume the previous one """
+        if not self.enabled: return
+        now = (time.perf_counter(), time.process_time())
+        name = self.stack.pop()
+        self._charge(name, now)
+        if sample: self.phases[name]["peak_rss"] = self.peak_rss()
+        self.mark = now
+
+    def _charge(self, name, now):
+        phase = self.phases.setdefault(name, {"wall": 0.0, "cpu": 0.0, 
+            "peak_rss": None})
+        phase["wall"]+= now[0] - self.mark[0]
+        phase["cpu"]+= now[1] - self.mark[1]
+
+    def phase(self, name):
+        """ context manager for a phase """
+        return _StatsPhase(self, name)
+
+    def iter(self, name, iterable, counter=None):
+        """
+        wrap iterable so time spent producing each item is charged to phase
+        name, optionally counting each item in counter.  Items are counted
+        and memory sampled as they are produced so the stats are complete
+        when the iterable is not read to the end (ex: --limit, | head)
+        """
+        if not self.enabled: return iterable
+        if counter is not None: self.count(counter, 0)
+        return self._iter(name, iter(iterable), counter)
+
+    def _iter(self, name, iterator, counter):
+        count = 0
+        while True:
+            self.enter(name)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.exit()
+                return
+            # peak RSS is sampled on the first item and every 1024 after
+            self.exit(count % 1024 == 0)
+            count+= 1
+            if counter is not None: self.count(counter)
+            yield item
+
+    def peak_rss(self):
+        """ peak resident memory of the process in bytes (or None) """
+        if resource is None: return None
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in KB elsewhere
+        if sys.platform != "darwin": rss*= 1024
+        return rss
+
+    def report(self):
+        """ stats as a dict """
+        phases = {}
+        for name in self.phases:
+            phase = self.phases[name]
+            phases[name] = {"wall": round(phase["wall"], 6), 
+                "cpu": round(phase["cpu"], 6), "peak_rss": phase["peak_rss"]}
+        return {
+            "phases": phases,
+            "counters": self.counters,
+            "total": {
+                "wall": round(time.perf_counter() - self.start[0], 6),
+                "cpu": round(time.process_time() - self.start[1], 6),
+                "peak_rss": self.peak_rss(),
+            },
+        }
+
+    def write(self, path="-"):
+        """ write stats as json to path, or stderr when path is '-' """
+        data = json.dumps(self.report(), sort_keys=True)
+        if path == "-":
+            sys.stderr.write(data + "\n")
+            sys.stderr.flush()
+        else:
+            with open(path, "w") as f: f.write(data + "\n")
+
+class _StatsPhase(object):
+    """ context manager returned by Stats.phase """
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.stats.enter(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        self.stats.exit()
+        return False
+
+# global instrumentation, enabled by --stats
+stats = Stats()
+
+class Record(object):
+    """
+    single parsed object holding its class name and attribute mapping.  The
+    moquery style text for the record is only formatted when it is printed
+    or searched.  Records built from text keep the original text in 'raw'
+    and their attributes are parsed from it on first access
+    """
+    __slots__ = ("cls", "_attrs", "raw")
+
+    def __init__(self, cls, attrs=None, raw=None):
+        self.cls = cls
+        self._attrs = attrs
+        self.raw = raw
+
+    @property
+    def attrs(self):
+        if self._attrs is None:
+            self._attrs = parse_text_attrs(self.raw or "")
+        return self._attrs
+
+    def get(self, attr, default=None):
+        return self.attrs.get(attr, default)
+
+    def text(self):
+        """ return moquery style text for this record """
+        if self.raw is not None: return self.raw
+        attrs = self._attrs
+        entry = ["# %s\n" % self.cls]
+        for a in attrs:
+            entry.append('{0:<16}: {1}\n'.format(a, attrs[a]))
+        return "".join(entry)
+
+    __str__ = text
+
+    def __reduce__(self):
+        return (Record, (self.cls, self._attrs, self.raw))
+
+    def __repr__(self):
+        return "Record(%r)" % self.cls
+
+# moquery style 'attribute   : value' lines and '# class' header
+attr_line_reg = re.compile("^[ \t]*([^\s:]+)[ \t]*:[ \t]?(.*)$", re.MULTILINE)
+class_line_reg = re.compile("^#[ \t]+([\w]+)")
+
+def parse_text_attrs(text):
+    """
+    build attribute dict from moquery style text, keeping the first value 
+    seen for each attribute
+    """
+    attrs = {}
+    for k, v in attr_line_reg.findall(text):
+        if k not in attrs: attrs[sys.intern(k)] = v
+    return attrs
+
+def record_from_text(text):
+    """ create a Record from a text entry, class taken from '# class' header """
+    r1 = class_line_reg.match(text)
+    return Record(r1.group(1) if r1 is not None else None, None, text)
+
+class OutputClosed(Exception):
+    """ raised by OutputWriter when the output pipe has been closed """
+    pass
+
+class OutputWriter(object):
+    """
+    buffered writer for result lines.  Lines are joined and written in large
+    blocks instead of one print per entry, buffered lines are also written
+    after flush_interval seconds so streamed results still show up 
+    promptly.  Writes to stdout unless a path or an already open text
+    stream is provided.  If the reader goes away (ex: piped to more or 
+    head), OutputClosed is raised so the caller can stop early and stdout 
+    is redirected to devnull so nothing is reported at exit
+    """
+    def __init__(self, path=None, buffer_size=1024*1024, flush_interval=0.5,
+            stream=None):
+        self.path = path
+        if stream is not None: self.stream = stream
+        elif path is None: self.stream = sys.stdout
+        else: self.stream = open(path, "w")
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.lines = []
+        self.size = 0
+        self.last_flush = time.time()
+        self.closed = False
+
+    def write(self, line):
+        """ add line to output (newline is appended, same as print) """
+        self.lines.append(line)
+        self.size+= len(line)
+        if self.size >= self.buffer_size or \
+            time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """ write all buffered lines """
+        if self.closed: raise OutputClosed()
+        if len(self.lines) == 0: return
+        data = "\n".join(self.lines) + "\n"
+        self.lines = []
+        self.size = 0
+        self.last_flush = time.time()
+        try:
+            self.stream.write(data)
+            self.stream.flush()
+        except BrokenPipeError:
+            self.closed = True
+            if self.stream is sys.stdout:
+                devnull = os.open(os.devnull, os.O_WRONLY)
+                os.dup2(devnull, self.stream.fileno())
+                os.close(devnull)
+            raise OutputClosed()
+
+    def close(self):
+        """ flush remaining lines and close output file """
+        try:
+            if not self.closed: self.flush()
+        finally:
+            if self.path is not None: self.stream.close()
+
+def dump_entries(entries, output=None):
     """
     dump entries in json file so user can save/redirect to a file
     Note - entries is a list so will create a dict wrapper for easy 
     import/export
     """
-    j = {"entries": entries}
-    print(json.dumps(j))
+    j = {"entries": [e.text() for e in entries]}
+    if output is None: output = OutputWriter()
+    output.write(json.dumps(j))
+    output.flush()
+
+def dump_snapshot(entries, output=None):
+    """
+    dump entries as an indexed binary snapshot (see SnapshotWriter) so user 
+    can save/redirect to a file.  Written to stdout by default, otherwise 
+    output is a binary file pointer
+    """
+    if output is None: output = sys.stdout.buffer
+    writer = SnapshotWriter(output)
+    for e in entries: writer.add(e)
+    writer.close()
+    try:
+        output.flush()
+    except BrokenPipeError:
+        raise OutputClosed()
 
 def restore_entries(input_file):
     """
-    rebuild entries from provided 'dump' file
+    rebuild entries from provided 'dump' file.  input_file must be opened in
+    binary mode.  Binary snapshots are memory mapped and returned as a lazy
+    Snapshot sequence, json dumps are fully loaded and can be read from a
+    pipe
     """
     start = time.time()
+    # peek leaves the position alone so json dumps can be streamed
+    if hasattr(input_file, "peek"):
+        magic = input_file.peek(len(SNAPSHOT_MAGIC))[0:len(SNAPSHOT_MAGIC)]
+    else:
+        magic = input_file.read(len(SNAPSHOT_MAGIC))
+        input_file.seek(0)
+    if magic == SNAPSHOT_MAGIC:
+        if not stat.S_ISREG(os.fstat(input_file.fileno()).st_mode):
+            raise Exception("snapshot restore needs a regular file: %s" % (
+                getattr(input_file, "name", input_file)))
+        entries = Snapshot(input_file)
+        logging.debug("restore time: %s" % td(start, time.time()))
+        logging.debug("restore entries: %s" % len(entries))
+        return entries
     j = json.load(input_file)
     if "entries" in j:
         logging.debug("restore time: %s" % td(start, time.time()))
         logging.debug("restore entries: %s" % len(j["entries"]))
-        return j["entries"]
+        return [record_from_text(e) for e in j["entries"]]
     else:
         raise Exception("Restore file not correctly formatted")
 
+SNAPSHOT_MAGIC = b"SPSNAP01"
+# attributes pre-extracted into snapshot key columns
+SNAPSHOT_KEYS = ("created", "id")
+
+class SnapshotWriter(object):
+    """
+    incrementally write records to a binary snapshot.  The output only needs
+    to support write() so it can be stdout.  Layout:
+        magic
+        records     utf-8 json per record, either [class, schema, values] 
+                    or [class, null, raw text] for records built from text
+        offsets     uint64 little endian offset of each record + end offset
+        keys        json list per pre-extracted key column
+        directory   json {"keys": {key: [start, end]}, "schemas": [names]}
+                    where schemas are the attribute name lists shared by
+                    records
+        trailer     magic, record count, offsets position, directory position
+    """
+    trailer = struct.Struct("<8sQQQ")
+
+    def __init__(self, output, keys=SNAPSHOT_KEYS):
+        self.output = output
+        self.keys = keys
+        self.columns = dict((k, []) for k in keys)
+        self.offsets = array.array("Q")
+        self.schemas = {}
+        self.encode = json.JSONEncoder(separators=(",", ":"), 
+            ensure_ascii=False).encode
+        self.pos = 0
+        self.write(SNAPSHOT_MAGIC)
+
+    def write(self, data):
+        self.output.write(data)
+        self.pos+= len(data)
+
+    def add(self, record):
+        """ append a single record """
+        self.offsets.append(self.pos)
+        attrs = record.attrs
+        if record.raw is None:
+            names = tuple(attrs)
+            schema = self.schemas.get(names)
+            if schema is None:
+                schema = self.schemas[names] = len(self.schemas)
+            data = [record.cls, schema, list(attrs.values())]
+        else:
+            data = [record.cls, None, record.raw]
+        self.write(self.encode(data).encode("utf-8"))
+        for k in self.keys:
+            self.columns[k].append(attrs.get(k))
+
+    def close(self):
+        """ write offset table, key columns and trailer """
+        count = len(self.offsets)
+        self.offsets.append(self.pos)
+        if sys.byteorder != "little": self.offsets.byteswap()
+        offsets_pos = self.pos
+        self.write(self.offsets.tobytes())
+        directory = {"keys": {}, "schemas": [None]*len(self.schemas)}
+        for names, schema in self.schemas.items():
+            directory["schemas"][schema] = names
+        for k in self.keys:
+            start = self.pos
+            self.write(json.dumps(self.columns[k]).encode("utf-8"))
+            directory["keys"][k] = [start, self.pos]
+        directory_pos = self.pos
+        self.write(json.dumps(directory).encode("utf-8"))
+        self.write(self.trailer.pack(SNAPSHOT_MAGIC, count, offsets_pos, 
+            directory_pos))
+
+class Snapshot(object):
+    """
+    read-only sequence of records backed by a memory mapped snapshot file.
+    Records are only decoded when accessed and key columns are only loaded
+    when used for sorting
+    """
+    def __init__(self, input_file):
+        self.path = getattr(input_file, "name", None)
+        self.mm = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+        trailer = SnapshotWriter.trailer
+        end = len(self.mm) - trailer.size
+        if end < len(SNAPSHOT_MAGIC):
+            raise Exception("Restore file not correctly formatted")
+        magic, count, offsets_pos, directory_pos = trailer.unpack_from(
+            self.mm, end)
+        if magic != SNAPSHOT_MAGIC:
+            raise Exception("Restore file not correctly formatted")
+        self.count = count
+        offsets = memoryview(self.mm)[offsets_pos:offsets_pos+8*(count+1)]
+        if sys.byteorder == "little":
+            self.offsets = offsets.cast("Q")
+        else:
+            self.offsets = array.array("Q", offsets.tobytes())
+            self.offsets.byteswap()
+        directory = json.loads(self.mm[directory_pos:end].decode("utf-8"))
+        self.directory = directory["keys"]
+        self.schemas = [tuple(sys.intern(a) for a in names) 
+            for names in directory["schemas"]]
+        self.columns = {}
+
+    @property
+    def keys(self):
+        """ attributes available as pre-extracted key columns """
+        return list(self.directory.keys())
+
+    def column(self, key):
+        """ list of the key's value (or None) for every record """
+        if key not in self.columns:
+            start, end = self.directory[key]
+            self.columns[key] = json.loads(self.mm[start:end].decode("utf-8"))
+        return self.columns[key]
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0: i+= self.count
+        if i < 0 or i >= self.count: raise IndexError(i)
+        cls, schema, values = json.loads(
+            self.mm[self.offsets[i]:self.offsets[i+1]].decode("utf-8"))
+        if schema is None: return Record(cls, None, values)
+        return Record(cls, dict(zip(self.schemas[schema], values)))
+
+    def __iter__(self):
+        for i in range(self.count): yield self[i]
+
+INDEX_MAGIC = b"SPIDX001"
+# attributes holding dns and the EntryIndex key indexing them, see entry_dns
+DN_ATTRS = ("dn", "affected")
+DN_INDEX_KEY = "@dn"
+# EntryIndex key indexing created as epoch milliseconds, see entry_time
+TIME_INDEX_KEY = "@created"
+
+class EntryIndex(object):
+    """
+    inverted index of attribute values to entry ids (position in entries)
+    used for --where and --under lookups.  The index for an attribute is 
+    built on first use with a single pass over entries, after that exact and
+    prefix lookups only touch the matching ids.  DN_INDEX_KEY indexes every
+    dn of the entry (see entry_dns) so subtrees are a prefix lookup, and 
+    TIME_INDEX_KEY indexes created timestamps so a time window is a range
+    of the sorted timestamps.  The index of a Snapshot is kept
+    in a '<snapshot>.idx' sidecar file so later runs reuse it.  Layout:
+        magic
+        per attribute   utf-8 json [sorted values, start of each value's 
+                        ids], followed by uint32 little endian entry ids 
+                        grouped by value
+        directory       json {"source": [count, size, mtime], "attrs": 
+                        {attr: [values start, ids start, ids end]}}
+        trailer         magic, directory position
+    """
+    trailer = struct.Struct("<8sQ")
+
+    def __init__(self, entries, path=None):
+        self.entries = entries
+        self.source = None
+        if path is None and isinstance(entries, Snapshot) and \
+            entries.path is not None:
+            path = "%s.idx" % entries.path
+            try:
+                st = os.stat(entries.path)
+                self.source = [len(entries), st.st_size, st.st_mtime_ns]
+            except OSError:
+                path = None
+        self.path = path
+        self.postings = {}
+        self.stored = None
+
+    def select(self, conditions, under=None, since=None, until=None):
+        """
+        return sorted ids of the entries matching all (attr, value, prefix)
+        conditions (see parse_where), with a dn under dn prefix under and
+        created within since and until (epoch ms)
+        """
+        attrs = [c[0] for c in conditions]
+        if under is not None: attrs.append(DN_INDEX_KEY)
+        if since is not None or until is not None: 
+            attrs.append(TIME_INDEX_KEY)
+        self.prepare(attrs)
+        matches = [self.lookup(*c) for c in conditions]
+        if under is not None: matches.append(self.under(under))
+        if since is not None or until is not None:
+            matches.append(self.between(since, until))
+        matches.sort(key=len)
+        ids = matches[0]
+        # probe the smallest result set against the others
+        for other in matches[1:]:
+            ids = [i for i in ids if self._contains(other, i)]
+        return ids
+
+    def _contains(self, ids, i):
+        """ True if i is in sorted sequence ids """
+        j = bisect.bisect_left(ids, i)
+        return j < len(ids) and ids[j] == i
+
+    def under(self, dn):
+        """ sorted ids of entries with a dn equal to or below dn """
+        dn = dn.rstrip("/")
+        exact = self.lookup(DN_INDEX_KEY, dn)
+        below = self.lookup(DN_INDEX_KEY, dn + "/", True)
+        if len(exact) == 0: return below
+        return sorted(set(exact).union(below))
+
+    def between(self, since=None, until=None):
+        """ sorted ids of entries created within since and until (epoch ms)"""
+        self.prepare([TIME_INDEX_KEY])
+        values, starts, ids = self.postings[TIME_INDEX_KEY]
+        i = 0 if since is None else bisect.bisect_left(values, since)
+        j = len(values) if until is None else bisect.bisect_right(values, 
+            until)
+        if i >= j: return ids[0:0]
+        return array.array("I", sorted(ids[starts[i]:starts[j]]))
+
+    def lookup(self, attr, value, prefix=False):
+        """ sorted ids of entries where attr equals (or starts with) value """
+        self.prepare([attr])
+        values, starts, ids = self.postings[attr]
+        i = bisect.bisect_left(values, value)
+        if not prefix:
+            if i < len(values) and values[i] == value:
+                return ids[starts[i]:starts[i+1]]
+            return ids[0:0]
+        # values sharing the prefix are adjacent in sorted order
+        j = i
+        while j < len(values) and values[j].startswith(value): j+= 1
+        if j - i == 1: return ids[starts[i]:starts[j]]
+        return array.array("I", sorted(ids[starts[i]:starts[j]]))
+
+    def prepare(self, attrs):
+        """ load or build the index of each attribute in attrs """
+        missing = [a for a in attrs if a not in self.postings and 
+            not self._load(a)]
+        if len(missing) == 0: return
+        start = time.time()
+        missing = list(collections.OrderedDict.fromkeys(missing))
+        groups = dict((a, {}) for a in missing)
+        for i, e in enumerate(self.entries):
+            attrs = e.attrs
+            for a in missing:
+                if a == DN_INDEX_KEY:
+                    for v in entry_dns(e): groups[a].setdefault(v, []).append(i)
+                    continue
+                if a == TIME_INDEX_KEY: v = entry_time(e)
+                else: v = attrs.get(a)
+                if v is not None: groups[a].setdefault(v, []).append(i)
+        for a in missing:
+            values = sorted(groups[a])
+            starts = [0]
+            ids = array.array("I")
+            for v in values:
+                ids.extend(groups[a][v])
+                starts.append(len(ids))
+            self.postings[a] = (values, starts, ids)
+        logging.debug("index build time: %s (%s)" % (td(start, time.time()),
+            ",".join(missing)))
+        self._save()
+
+    def _directory(self):
+        """ attribute directory of the sidecar, empty if missing or stale """
+        if self.stored is not None: return self.stored
+        self.stored = {}
+        if self.path is None: return self.stored
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(-self.trailer.size, 2)
+                end = f.tell()
+                magic, pos = self.trailer.unpack(f.read(self.trailer.size))
+                if magic != INDEX_MAGIC: return self.stored
+                f.seek(pos)
+                directory = json.loads(f.read(end - pos).decode("utf-8"))
+        except (IOError, OSError, ValueError, struct.error):
+            return self.stored
+        if directory["source"] == self.source:
+            self.stored = directory["attrs"]
+        else:
+            logging.debug("ignoring stale index %s" % self.path)
+        return self.stored
+
+    def _load(self, attr):
+        """ load attribute index from the sidecar, False if not stored """
+        if attr not in self._directory(): return False
+        values_pos, ids_pos, end = self.stored[attr]
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(values_pos)
+                values, starts = json.loads(
+                    f.read(ids_pos - values_pos).decode("utf-8"))
+                ids = array.array("I")
+                ids.frombytes(f.read(end - ids_pos))
+        except (IOError, OSError, ValueError):
+            return False
+        if sys.byteorder != "little": ids.byteswap()
+        self.postings[attr] = (values, starts, ids)
+        logging.debug("index loaded: %s" % attr)
+        return True
+
+    def _save(self):
+        """ rewrite the sidecar with every indexed attribute """
+        if self.path is None: return
+        for a in list(self._directory()):
+            if a not in self.postings: self._load(a)
+        tmp = "%s.%d.tmp" % (self.path, os.getpid())
+        directory = {"source": self.source, "attrs": {}}
+        try:
+            with open(tmp, "wb") as f:
+                f.write(INDEX_MAGIC)
+                for a, (values, starts, ids) in self.postings.items():
+                    values_pos = f.tell()
+                    f.write(json.dumps([values, starts], 
+                        ensure_ascii=False).encode("utf-8"))
+                    ids_pos = f.tell()
+                    if sys.byteorder != "little":
+                        ids = array.array("I", ids)
+                        ids.byteswap()
+                    f.write(ids.tobytes())
+                    directory["attrs"][a] = [values_pos, ids_pos, f.tell()]
+                pos = f.tell()
+                f.write(json.dumps(directory).encode("utf-8"))
+                f.write(self.trailer.pack(INDEX_MAGIC, pos))
+            os.rename(tmp, self.path)
+            self.stored = directory["attrs"]
+        except (IOError, OSError) as e:
+            logging.debug("unable to write index %s: %s" % (self.path, e))
+            try: os.unlink(tmp)
+            except OSError: pass
+
 def search_entries(entries, regex, ignore_case=False, sort_reg=None, 
         sort_neg=False, retro_option=False, retro_space=False, retro_month=False, retro_full=False,
-        retro_deletion=False):
+        retro_deletion=False, sort_attr=None, output=None, limit=None, 
+        tail=None, where=None, index=None, under=None, since=None, 
+        until=None, retro_space_gap=3, jobs=1, group_by=None, bucket=None,
+        follow=None):
     """
     loop through entries list and print each full entry that matches regex
+    (or any regex of a list of patterns, see Matcher).
+    Results are written to output (OutputWriter, stdout by default) and the
+    search stops early if the output is closed.  With retro_space, an empty
+    line separates records created retro_space_gap seconds or more apart
+
+    results are sorted on the typed values of attribute(s) sort_attr (list
+    or comma separated string), or on the value matched by sort_reg against
+    the entry text (named group 'm').  See typed_value
+
+    entries can be a list or any iterable (such as iter_from_xml).  When no 
+    sort is requested, entries are filtered and printed as they are produced
+    so output starts before the full input has been read
+
+    limit prints only the first N results and tail only the last N.  When
+    sorting, a bounded heap keeps the N results instead of sorting the full
+    set.  Without a sort, limit stops reading entries after N results
+
+    where is a list of (attr, value, prefix) conditions (see parse_where) 
+    that entries must all match, under is a dn prefix that one of the
+    entry dns must be equal to or below (see entry_dns) and since/until
+    bound the created time in epoch milliseconds.  They are answered
+    from index (EntryIndex) when provided or when entries is a Snapshot, so
+    only the matching entries are read.  Other entries are checked one by 
+    one
+
+    with jobs other than 1 (0 for all cores), the regex filter over a list 
+    or Snapshot is split into shards searched by worker processes
+
+    group_by (list or comma separated attributes) and/or bucket (seconds of
+    created time) print one line per group with its count and first and
+    last seen instead of the entries, see group_entries.  Sort and retro
+    options do not apply to groups, limit and tail apply to the group lines
+
+    follow (FollowState) records the newest printed entry of each class, 
+    every grouped entry counts as printed
     """
 
-    results = []
     logging.debug("regex: %s, ignore_case: %r, negative: %r" % (regex, ignore_case, sort_neg))
+    if limit is not None and tail is not None:
+        raise Exception("limit and tail are mutually exclusive")
     start = time.time()
-    matches = 0
-    if ignore_case and regex is not None:
-        for e in entries:
-            matched = False
-            if re.search(regex, e, re.IGNORECASE):
-                matches+=1
-                matched=True
-            if (matched and not sort_neg) or (not matched and sort_neg):
-                results.append(e)
+    counter = {"matches": 0, "sort_hits": 0}
+    sort_attrs = split_sort_attrs(sort_attr)
+    limiting = limit is not None or tail is not None
+    group_attrs = split_sort_attrs(group_by)
+    grouping = len(group_attrs) > 0 or bucket is not None
+    if grouping: 
+        sort_attrs = []
+        sort_reg = None
+        retro_option = False
+    # retro drops suppressed faults, they are dropped before limiting so
+    # that N records are printed
+    suppress = (limiting or follow is not None) and retro_option and \
+        not retro_deletion
+    # snapshots hold pre-extracted sort keys so the sort runs over record
+    # indexes and records are only decoded when printed
+    snapshot_sort = (regex is None and len(sort_attrs) > 0 and 
+        isinstance(entries, Snapshot) and 
+        all(a in entries.keys for a in sort_attrs))
+    # same for groups on key columns
+    snapshot_group = (regex is None and grouping and follow is None and
+        isinstance(entries, Snapshot) and 
+        all(a in entries.keys for a in group_attrs + ["created"]))
+    # entries that can be split into shards for a parallel filter
+    source = entries if isinstance(entries, (list, Snapshot)) else None
+    ids = None
+    where = where or []
+    window = since is not None or until is not None
+    if len(where) > 0 or under is not None or window:
+        if index is None and isinstance(entries, Snapshot):
+            index = EntryIndex(entries)
+        if index is not None:
+            with stats.phase("search"):
+                ids = index.select(where, under, since, until)
+            logging.debug("where matches: %d" % len(ids))
+            if not snapshot_sort and not snapshot_group:
+                entries = map(entries.__getitem__, ids)
+        else:
+            source = None
+            entries = (e for e in entries if where_matches(e, where) and
+                (under is None or dn_under(e, under)) and
+                (not window or time_matches(e, since, until)))
+    if snapshot_sort or snapshot_group:
+        results = range(len(entries)) if ids is None else ids
     elif regex is not None:
-        for e in entries:
-            matched = False
-            if re.search(regex, e):
-                matches+=1
-                matched=True
-            if (matched and not sort_neg) or (not matched and sort_neg):
-                results.append(e)
+        if jobs != 1 and source is not None:
+            results = __filter_parallel(source, ids, regex, ignore_case, 
+                sort_neg, counter, jobs)
+        else:
+            results = __filter_entries(entries, regex, ignore_case, sort_neg,
+                counter)
+        results = stats.iter("search", results)
     else:
         # get all entries
-        results = entries
+        results = iter(entries)
+    if suppress and not snapshot_sort:
+        results = (r for r in results if not retro_suppressed(r))
+
+    if grouping:
+        with stats.phase("group"):
+            if snapshot_group:
+                columns = [entries.column(a) for a in group_attrs]
+                created = entries.column("created")
+                groups = aggregate_groups(((tuple([c[i] for c in columns]), 
+                    created[i]) for i in results), bucket)
+            else:
+                if follow is not None: results = follow.iter_emitted(results)
+                groups = group_entries(results, group_attrs, bucket)
+        logging.debug("group time: %s, groups: %d" % (td(start, time.time()),
+            len(groups)))
+        stats.count("matches", counter["matches"])
+        stats.count("groups", len(groups))
+        lines = format_groups(groups, group_attrs, bucket)
+        # header is kept when limiting the group lines
+        if limit is not None:
+            lines = lines[0:limit+1]
+        elif tail is not None:
+            lines = lines[0:1] + lines[max(1, len(lines)-tail):]
+        if output is None: output = OutputWriter()
+        with stats.phase("output"):
+            try:
+                for line in lines:
+                    output.write(line)
+                    stats.count("output")
+                output.flush()
+            except OutputClosed:
+                logging.debug("output closed, stopping search")
+        return
 
-    logging.debug("search time: %s" % td(start, time.time()))
-    logging.debug("search matches: %d" % matches)
-    if len(results) == 0:
+    # a full sort needs the full result set, limited sorts keep only N 
+    # results in a heap, otherwise stream the results
+    sorting = sort_reg is not None or len(sort_attrs) > 0
+    heap = sorting and limiting and not (snapshot_sort and suppress)
+    if sorting and not heap:
+        results = list(results)
+        logging.debug("search time: %s" % td(start, time.time()))
+        logging.debug("search matches: %d" % counter["matches"])
+    
+    # peek at the first result to detect an empty result set
+    results = iter(results)
+    first = next(results, None)
+    if first is None:
         logging.debug("no results to print")
+        stats.count("matches", counter["matches"])
         return
-    
+    results = itertools.chain([first], results)
+
     # sort the 'filtered' results into final result list
     final_results = []
-    if sort_reg is not None:
-        logging.debug("sort_reg: %s" % sort_reg)
-        sort_match_count = 0
+    if sorting:
+        logging.debug("sort_reg: %s, sort_attr: %s" % (sort_reg, sort_attr))
         start = time.time()
-        ts_results_default = []     # catch all if we don't match any results
-        ts_results = {}
-        for r in results:
-            r1 = re.search(sort_reg, r)
-            if r1 is not None:
-                sort_match_count+= 1
-                m = r1.group("m")
-                if m not in ts_results: 
-                    ts_results[m] = []
-                ts_results[m].append(r)
-            else:
-                ts_results_default.append(r)
-        # final results is combined ts_results_default and sorted results
-        final_results = ts_results_default
-        for k in sorted(ts_results):
-            final_results+= ts_results[k]
+        stats.enter("sort")
+        # build typed key for each result once, results missing the (first)
+        # key are placed first
+        if snapshot_sort:
+            columns = [entries.column(a) for a in sort_attrs]
+            key = lambda i: tuple([typed_value(__sort_token(c[i])) 
+                for c in columns])
+        elif len(sort_attrs) > 0:
+            key = sort_key_func(sort_attrs)
+        else:
+            reg = re.compile(sort_reg)
+            def key(r):
+                r1 = reg.search(r.text())
+                return (typed_value(r1.group("m") if r1 else None),)
+
+        def counted_key(r):
+            k = key(r)
+            if k[0][0] != 0: counter["sort_hits"]+= 1
+            return k
+
+        if heap and limit is not None:
+            # same result as the first N of a stable sort
+            final_results = heapq.nsmallest(limit, results, key=counted_key)
+        elif heap:
+            # position breaks ties so equal keys keep their input order
+            final_results = [t[2] for t in reversed(heapq.nlargest(tail, (
+                (counted_key(r), i, r) for i, r in enumerate(results))))]
+        else:
+            # single stable sort on the prebuilt keys
+            results = list(results)
+            keys = [counted_key(r) for r in results]
+            order = sorted(range(len(keys)), key=keys.__getitem__)
+            final_results = [results[i] for i in order]
+        stats.exit()
+        stats.count("sort_hits", counter["sort_hits"])
+        if snapshot_sort:
+            final_results = stats.iter("load", 
+                (entries[i] for i in final_results))
+            if suppress:
+                final_results = (r for r in final_results 
+                    if not retro_suppressed(r))
         logging.debug("sort attribute time: %s" % td(start, time.time()))
-        logging.debug("sort attribute matches: %d" % sort_match_count)
+        logging.debug("sort attribute matches: %d" % counter["sort_hits"])
     else:
         final_results = results
 
-    # print all results (peek first for suppot for retro_peek)
-    if retro_option:
-        retro_peek = results[0].splitlines()[0]
-        if "# aaaModLR" in retro_peek:
-            new_results = aaa_entry_parse(final_results, retro_full)
-        elif "# eventRecord" in retro_peek:
-            new_results = event_entry_parse(final_results, retro_full)
-        elif "# faultRecord" in retro_peek:
-            new_results = fault_entry_parse(final_results, retro_full, retro_deletion)
-        else:
-            logging.error("Unable to Determine Record Type")
-            new_results = final_results
+    # limit stops pulling results (and reading input) after N, tail keeps
+    # the last N results.  Only the printed results are retro formatted
+    if limit is not None:
+        final_results = itertools.islice(final_results, limit)
+    elif tail is not None:
+        final_results = collections.deque(final_results, maxlen=tail)
 
-        if retro_space:
-            new_results = space_option(new_results)
-        for e in new_results:
+    # only printed results move the follow checkpoint
+    if follow is not None: 
+        final_results = follow.iter_emitted(final_results)
+
+    # print all results, retro layout is chosen per record
+    if output is None: output = OutputWriter()
+    stats.enter("output")
+    try:
+        if retro_option:
+            new_results = stats.iter("retro", retro_entry_parse(final_results,
+                retro_full, retro_deletion, records=retro_space))
+
+            if retro_space:
+                new_results = space_option(new_results, retro_space_gap)
             if retro_month:
-                print(letter_month(e))
-            else:
-                print(e)
-    # normal non-retro printing
-    else:
-        for r in final_results:
-            print("".join(r))
+                new_results = (letter_month(e) for e in new_results)
+            for e in new_results:
+                output.write(e)
+                stats.count("output")
+        # normal non-retro printing
+        else:
+            for r in final_results:
+                output.write(r.text())
+                stats.count("output")
+        output.flush()
+    except OutputClosed:
+        logging.debug("output closed, stopping search")
+    stats.exit()
+    stats.count("matches", counter["matches"])
+
+    if not sorting:
+        logging.debug("search and print time: %s" % td(start, time.time()))
+        logging.debug("search matches: %d" % counter["matches"])
+
+def group_entries(entries, group_by, bucket=None):
+    """
+    aggregate entries on the values of attributes group_by (list or comma 
+    separated string) and, with bucket (seconds), on their created time 
+    rounded down to a multiple of bucket.  See aggregate_groups
+    """
+    attrs = split_sort_attrs(group_by)
+    return aggregate_groups(((tuple([e.attrs.get(a) for a in attrs]), 
+        e.attrs.get("created")) for e in entries), bucket)
+
+def aggregate_groups(rows, bucket=None):
+    """
+    hash aggregation of (values tuple, created) rows in a single pass, so
+    memory grows with the number of groups and not with the number of rows.
+    Returns dict of group key (values, prefixed with the bucket start in 
+    epoch ms or None when bucket is set) to [count, first ms, first 
+    created, last ms, last created] where first and last are the oldest and
+    newest created seen (None if no row of the group has one)
+    """
+    groups = {}
+    bucket_ms = int(bucket * 1000) if bucket is not None else None
+    for values, created in rows:
+        ms = parse_timestamp(created) if created else None
+        if ms is None: created = None
+        if bucket_ms is not None:
+            values = (None if ms is None else ms - ms % bucket_ms,) + values
+        g = groups.get(values)
+        if g is None:
+            groups[values] = [1, ms, created, ms, created]
+            continue
+        g[0]+= 1
+        if ms is None: continue
+        if g[1] is None or ms < g[1]:
+            g[1] = ms
+            g[2] = created
+        if g[3] is None or ms > g[3]:
+            g[3] = ms
+            g[4] = created
+    return groups
+
+def format_groups(groups, group_attrs, bucket=None):
+    """
+    list of aligned lines (header first) for groups from aggregate_groups.
+    Groups are ordered by count, most frequent first, and by bucket first
+    when bucketed.  Bucket start is printed in UTC and missing values as '-'
+    """
+    header = ["count"]
+    if bucket is not None: header.append("created")
+    header.extend(group_attrs)
+    header.extend(["first", "last"])
+    def order(item):
+        values, g = item
+        keys = [-g[0]] + [("" if v is None else v) for v in values]
+        if bucket is not None: 
+            keys = [-1 if values[0] is None else values[0]] + keys
+        return keys
+    rows = [header]
+    for values, g in sorted(groups.items(), key=order):
+        row = ["%d" % g[0]]
+        for i, v in enumerate(values):
+            if v is None: v = "-"
+            elif i == 0 and bucket is not None:
+                v = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(v/1000))
+            row.append(v)
+        row.append(__retro_created(g[2]) if g[2] is not None else "-")
+        row.append(__retro_created(g[4]) if g[4] is not None else "-")
+        rows.append(row)
+    widths = [max(len(r[i]) for r in rows) for i in range(len(header))]
+    return [("  ".join(v.ljust(widths[i]) for i, v in enumerate(r))).rstrip()
+        for r in rows]
+
+def __filter_entries(entries, regex, ignore_case, sort_neg, counter):
+    """
+    generator yielding each entry that matches regex (or any of a list of 
+    regexes), or does not match when sort_neg is set.  Number of regex 
+    matches is tracked in counter
+    """
+    search = Matcher(regex, ignore_case).search
+    for e in entries:
+        matched = search(e.text())
+        if matched: counter["matches"]+= 1
+        if matched != sort_neg: yield e
+
+class Matcher(object):
+    """
+    match text against any of a list of regexes.  The patterns are joined
+    into a single alternation when they allow it so text is scanned once.
+    When every pattern requires some literal string (see required_literals)
+    a search for any of these literals runs first, it rejects most text
+    far faster than the alternation which tries each branch at each 
+    position.  Large lists of patterns then cost little more than one
+    """
+    def __init__(self, patterns, ignore_case=False):
+        if isinstance(patterns, str): patterns = [patterns]
+        flags = re.IGNORECASE if ignore_case else 0
+        compiled = [re.compile(p, flags) for p in patterns]
+        self.searches = [c.search for c in compiled]
+        self.search_all = None
+        self.prefilter = None
+        self.prefilter_folded = None
+        self.prefiltered = False
+        if len(patterns) < 2: return
+        # backreferences are numbered across the whole alternation and 
+        # inline global flags are only allowed at its start
+        if not any(group_ref_reg.search(p) for p in patterns):
+            try:
+                self.search_all = re.compile("|".join("(?:%s)" % p 
+                    for p in patterns), flags).search
+            except re.error as e:
+                logging.debug("unable to join patterns: %s" % e)
+        sensitive = set()
+        folded = set()
+        for p, c in zip(patterns, compiled):
+            literals = required_literals(p, flags)
+            if literals is None: return
+            if not c.flags & re.IGNORECASE: 
+                sensitive.update(literals)
+                continue
+            # case insensitive literals are searched in lower cased text,
+            # only ascii is folded the same by lower() and re
+            if not all(l.isascii() for l in literals): return
+            folded.update(l.lower() for l in literals)
+        self.prefilter = self._literal_search(sensitive)
+        self.prefilter_folded = self._literal_search(folded)
+        self.prefiltered = True
+
+    def _literal_search(self, literals):
+        """ search method of regex matching any of literals """
+        if len(literals) == 0: return None
+        # longer literals first, any match is enough
+        return re.compile("|".join(re.escape(l) for l in 
+            sorted(literals, key=len, reverse=True))).search
+
+    def search(self, text):
+        """ True if text matches any of the patterns """
+        if self.prefiltered and (self.prefilter is None or 
+            self.prefilter(text) is None):
+            # case insensitive literals can only rule out ascii text
+            if self.prefilter_folded is None: return False
+            if text.isascii() and self.prefilter_folded(text.lower()) is None:
+                return False
+        if self.search_all is not None: 
+            return self.search_all(text) is not None
+        for search in self.searches:
+            if search(text) is not None: return True
+        return False
+
+def required_literals(pattern, flags=0):
+    """
+    return a set of literal strings, at least one of which is in any text 
+    matching pattern (ex: 'F0532' for 'code +: F0532', or 'F0532' and 
+    'F1394' for 'F0532|F1394'), or None if no such set is found.  Literals 
+    are case sensitive unless the pattern is case insensitive
+    """
+    try:
+        return __sequence_literals(list(sre_parse.parse(pattern, flags)))
+    except Exception as e:
+        logging.debug("unable to parse literals of %s: %s" % (pattern, e))
+        return None
+
+# backreference or conditional group in a pattern
+group_ref_reg = re.compile(r"\\[1-9]|\(\?P=|\(\?\(")
+# regex parser operations whose content is matched at least once
+__group_ops = tuple(o for o in (getattr(sre_parse, "ATOMIC_GROUP", None),) 
+    if o is not None)
+__repeat_ops = tuple(getattr(sre_parse, o) for o in ("MAX_REPEAT", 
+    "MIN_REPEAT", "POSSESSIVE_REPEAT") if hasattr(sre_parse, o))
+
+def __sequence_literals(items):
+    """
+    best literal set of a parsed regex sequence, see required_literals.  
+    Each run of literals and each required group gives a candidate set, the
+    set with the longest shortest literal is the most selective
+    """
+    candidates = []
+    run = []
+    for op, av in items + [(None, None)]:
+        if op is sre_parse.LITERAL:
+            run.append(chr(av))
+            continue
+        if len(run) > 0:
+            candidates.append(set(["".join(run)]))
+            run = []
+        literals = None
+        if op is sre_parse.SUBPATTERN:
+            group, add_flags, del_flags, p = av
+            # locally case insensitive groups are skipped
+            if not add_flags & re.IGNORECASE:
+                literals = __sequence_literals(list(p))
+        elif op is sre_parse.BRANCH:
+            branches = [__sequence_literals(list(b)) for b in av[1]]
+            if all(b is not None for b in branches):
+                literals = set().union(*branches)
+        elif op in __repeat_ops:
+            low, high, p = av
+            if low > 0: literals = __sequence_literals(list(p))
+        elif op in __group_ops:
+            literals = __sequence_literals(list(av))
+        if literals: candidates.append(literals)
+    if len(candidates) == 0: return None
+    return max(candidates, key=lambda c: (min(len(l) for l in c), -len(c)))
+
+# entries (and selected entry ids) inherited by forked filter workers
+_SHARD_ENTRIES = None
+_SHARD_IDS = None
+# minimum number of entries per filter shard
+_SHARD_MIN = 10000
+# (patterns, ignore case) and Matcher of a filter worker
+_SHARD_MATCHER = None
+
+def __filter_parallel(entries, ids, regex, ignore_case, sort_neg, counter, 
+        jobs):
+    """
+    same as __filter_entries for a list or Snapshot (or the entries at ids
+    within it).  The entries are split into shards filtered by a pool of
+    'jobs' forked worker processes which inherit the entries, so only the
+    shard bounds and the matching entry ids are passed between processes.
+    Results keep the entries order.  Falls back to a serial filter for 
+    small inputs or where fork is not available
+    """
+    global _SHARD_ENTRIES, _SHARD_IDS
+    import multiprocessing
+    if jobs <= 0: jobs = os.cpu_count() or 1
+    count = len(entries) if ids is None else len(ids)
+    size = max(_SHARD_MIN, -(-count // (jobs * 4)))
+    ctx = None
+    if jobs > 1 and count > size:
+        try: ctx = multiprocessing.get_context("fork")
+        except ValueError: pass
+    if ctx is None:
+        if ids is not None: entries = map(entries.__getitem__, ids)
+        for e in __filter_entries(entries, regex, ignore_case, sort_neg, 
+            counter):
+            yield e
+        return
+
+    start = time.time()
+    if isinstance(regex, str): regex = [regex]
+    work = [(s, min(s + size, count), tuple(regex), ignore_case, sort_neg) 
+        for s in range(0, count, size)]
+    _SHARD_ENTRIES, _SHARD_IDS = entries, ids
+    pool = ctx.Pool(min(jobs, len(work)))
+    try:
+        for positions, matches in pool.imap(__filter_shard, work):
+            counter["matches"]+= matches
+            for i in positions: yield entries[i]
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        _SHARD_ENTRIES, _SHARD_IDS = None, None
+    logging.debug("parallel search time (%d jobs, %d shards): %s" % (jobs,
+        len(work), td(start, time.time())))
+
+def __filter_shard(job):
+    """
+    filter worker, returns the ids of the entries kept from shard [start, 
+    end) and the number of regex matches.  The Matcher is built once per 
+    worker and reused for its following shards
+    """
+    global _SHARD_MATCHER
+    start, end, patterns, ignore_case, sort_neg = job
+    if _SHARD_MATCHER is None or _SHARD_MATCHER[0] != (patterns, ignore_case):
+        _SHARD_MATCHER = ((patterns, ignore_case), 
+            Matcher(list(patterns), ignore_case))
+    search = _SHARD_MATCHER[1].search
+    entries, ids = _SHARD_ENTRIES, _SHARD_IDS
+    kept = array.array("I")
+    matches = 0
+    for k in range(start, end):
+        i = k if ids is None else ids[k]
+        matched = search(entries[i].text())
+        if matched: matches+= 1
+        if matched != sort_neg: kept.append(i)
+    return kept, matches
+
+def parse_where(condition):
+    """
+    parse 'attr=value' (exact) or 'attr=prefix*' (prefix) filter into 
+    (attr, value, prefix) tuple, raises ValueError if invalid
+    """
+    attr, sep, value = condition.partition("=")
+    attr = attr.strip()
+    if not sep or len(attr) == 0:
+        raise ValueError("expected attr=value: %s" % condition)
+    if value.endswith("*"): return (attr, value[:-1], True)
+    return (attr, value, False)
+
+def where_matches(entry, conditions):
+    """ True if entry matches all (attr, value, prefix) conditions """
+    attrs = entry.attrs
+    for attr, value, prefix in conditions:
+        v = attrs.get(attr)
+        if v is None: return False
+        if prefix:
+            if not v.startswith(value): return False
+        elif v != value: return False
+    return True
+
+dn_bracket_reg = re.compile("[\\[\\]]")
+
+def entry_dns(entry):
+    """
+    set of dns referenced by entry: its dn and affected attributes and any
+    dn nested in brackets within them, ex: the rspathAtt dn
+        uni/tn-A/ap-A/epg-A/rspathAtt-[topology/pod-1/paths-102/pathep-[eth1/1]]
+    also references topology/pod-1/paths-102/pathep-[eth1/1] and eth1/1
+    """
+    dns = set()
+    attrs = entry.attrs
+    for a in DN_ATTRS:
+        v = attrs.get(a)
+        if not v: continue
+        dns.add(v)
+        opened = []
+        for r1 in dn_bracket_reg.finditer(v):
+            if r1.group(0) == "[": opened.append(r1.end())
+            elif len(opened) > 0: dns.add(v[opened.pop():r1.start()])
+    return dns
+
+def dn_under(entry, dn):
+    """ True if entry references a dn equal to or below dn """
+    dn = dn.rstrip("/")
+    below = dn + "/"
+    for d in entry_dns(entry):
+        if d == dn or d.startswith(below): return True
+    return False
+
+def split_sort_attrs(sort_attr):
+    """ list of sort attributes from a comma separated string or list """
+    if sort_attr is None: return []
+    if isinstance(sort_attr, str): sort_attr = sort_attr.split(",")
+    return [a.strip() for a in sort_attr if len(a.strip()) > 0]
+
+def sort_key_func(sort_attrs):
+    """
+    return key function mapping a record to a tuple of typed values (see 
+    typed_value) for each attribute in sort_attrs
+    """
+    attrs = tuple(split_sort_attrs(sort_attrs))
+    if len(attrs) == 1:
+        attr = attrs[0]
+        return lambda r: (typed_value(__sort_token(r.attrs.get(attr))),)
+    return lambda r: tuple([typed_value(__sort_token(r.attrs.get(a))) 
+        for a in attrs])
+
+timestamp_reg = re.compile("([0-9]{4})-([0-9]{2})-([0-9]{2})[T ]([0-9]{2}):"
+    "([0-9]{2}):([0-9]{2})(?:\\.([0-9]+))?(Z|[+-][0-9]{2}:?[0-9]{2})?$")
+integer_reg = re.compile("-?[0-9]+$")
+__epoch_days = {}
+
+def parse_timestamp(value):
+    """
+    parse ISO 8601 timestamp such as 2020-05-29T16:30:45.066+00:00 into 
+    epoch milliseconds.  Timestamps without an offset are treated as UTC.
+    Returns None if value is not a timestamp
+    """
+    r1 = timestamp_reg.match(value)
+    if r1 is None: return None
+    y, mo, d, h, mi, sec, frac, tz = r1.groups()
+    day = value[0:10]
+    seconds = __epoch_days.get(day)
+    if seconds is None:
+        seconds = calendar.timegm((int(y), int(mo), int(d), 0, 0, 0, 0, 0, 0))
+        __epoch_days[day] = seconds
+    ms = (seconds + int(h)*3600 + int(mi)*60 + int(sec)) * 1000
+    if frac is not None: ms+= int(frac[0:3].ljust(3, "0"))
+    if tz is not None and tz != "Z":
+        offset = (int(tz[1:3])*60 + int(tz[-2:])) * 60000
+        ms+= -offset if tz[0] == "+" else offset
+    return ms
+
+duration_reg = re.compile("([0-9]+(?:\\.[0-9]+)?)(ms|[wdhms]?)")
+number_reg = re.compile("[0-9]+(?:\\.[0-9]+)?$")
+duration_units = {"ms": 0.001, "": 1, "s": 1, "m": 60, "h": 3600, 
+    "d": 86400, "w": 604800}
+
+def parse_duration(value):
+    """
+    parse duration such as 3s, 500ms, 5m, 2h, 1d, 1w or combinations such 
+    as 1h30m into seconds.  Numbers without unit are seconds.  Raises 
+    ValueError if value is not a duration
+    """
+    seconds = 0
+    pos = 0
+    value = value.strip()
+    for r1 in duration_reg.finditer(value):
+        if r1.start() != pos: break
+        seconds+= float(r1.group(1)) * duration_units[r1.group(2)]
+        pos = r1.end()
+    if pos == 0 or pos != len(value):
+        raise ValueError("invalid duration: %s" % value)
+    return seconds
+
+def positive_duration(value):
+    """ parse duration (see parse_duration) of at least 1ms """
+    seconds = parse_duration(value)
+    if seconds < 0.001: 
+        raise ValueError("duration must be positive: %s" % value)
+    return seconds
+
+def parse_time(value, now=None):
+    """
+    parse --since/--until value into epoch milliseconds.  Value is either 
+    an ISO timestamp (2020-05-29T13:50:45, date only or without seconds is
+    allowed, UTC unless an offset is given) or a duration before now (see
+    parse_duration) which must have a unit so a year such as 2020 is not
+    read as seconds.  Raises ValueError if value is neither
+    """
+    value = value.strip()
+    for suffix in ("", ":00", "T00:00:00"):
+        ms = parse_timestamp(value + suffix)
+        if ms is not None: return ms
+    if not number_reg.match(value):
+        try:
+            if now is None: now = time.time()
+            return int((now - parse_duration(value)) * 1000)
+        except ValueError:
+            pass
+    raise ValueError("invalid timestamp or duration (ex: 2020-05-29, "
+        "30m): %s" % value)
+
+def entry_time(entry):
+    """ created timestamp of entry in epoch milliseconds or None """
+    created = entry.attrs.get("created")
+    if not created: return None
+    return parse_timestamp(created)
+
+def time_matches(entry, since=None, until=None):
+    """ True if entry was created within since and until (epoch ms) """
+    ms = entry_time(entry)
+    if ms is None: return False
+    return (since is None or ms >= since) and (until is None or ms <= until)
+
+def iter_time_window(entries, since=None, until=None, order="desc"):
+    """
+    yield entries created within since and until (epoch ms) from entries
+    ordered by created (asc or desc), reading stops once entries are past
+    the window.  Entries without a created timestamp are skipped
+    """
+    for e in entries:
+        ms = entry_time(e)
+        if ms is None: continue
+        if order == "desc":
+            if since is not None and ms < since: return
+            if until is not None and ms > until: continue
+        else:
+            if until is not None and ms > until: return
+            if since is not None and ms < since: continue
+        yield e
+
+def typed_value(v):
+    """
+    convert a sort value into a (rank, value) tuple so that values compare
+    as native types: missing values first (rank 0), then timestamps (as 
+    epoch milliseconds) and integers (rank 1), then strings (rank 2)
+    """
+    if v is None or len(v) == 0: return (0, 0)
+    if integer_reg.match(v): return (1, int(v))
+    ts = parse_timestamp(v)
+    if ts is not None: return (1, ts)
+    return (2, v)
+
+def __sort_token(v):
+    """ first token of an attribute value (None if missing or empty) """
+    if v is None: return None
+    v = v.lstrip(" \t").split("\n", 1)[0].split(" ", 1)[0]
+    if len(v) == 0: return None
+    return v
   
 def build_from_text(input_file, start_reg="^#[ \t]+[\w]+", 
         allow_empty_lines=False):
@@ -155,7 +1403,95 @@ def build_from_text(input_file, start_reg="^#[ \t]+[\w]+",
     """
     logging.debug("build from test regex: \"%s\"" % start_reg)
     start = time.time()
-    entries = []
+    entries = list(iter_from_text(input_file, start_reg, allow_empty_lines))
+
+    # return the result
+    logging.debug("build entries time: %s" % td(start, time.time()))
+    logging.debug("entries built from text: %s" % len(entries))
+    return entries
+
+# blank line ending an entry (same as line.strip() being empty) preceded by
+# the newline ending the previous line
+blank_line_reg = re.compile("\n[^\\S\n]*(?:\n|\\Z)")
+# start_reg constructs that can match differently at the start or the end 
+# of a single line than within a block, these are parsed line by line
+text_line_only = ("\\A", "\\Z", "\\b", "\\B", "$", "(?=", "(?!", "(?<")
+
+def iter_from_text(input_file, start_reg="^#[ \t]+[\w]+", 
+        allow_empty_lines=False, block_size=4*1024*1024):
+    """
+    generator yielding entries from text input.  Each entry starts with a
+    line matching start_reg and ends at the next start line or, unless 
+    allow_empty_lines is set, at the first empty line.  The input is read
+    in blocks and start lines are found with a single multiline search per
+    entry instead of a search per line.  Each candidate line is checked 
+    with start_reg on its own so results are the same as a line by line 
+    search
+    """
+    if any(c in start_reg for c in text_line_only):
+        for e in __iter_text_lines(input_file, start_reg, allow_empty_lines):
+            yield e
+        return
+    line_reg = re.compile(start_reg)
+    # blocks always start with a newline so every line follows one, a start
+    # line anchored with ^ is then searched as newline + pattern which is
+    # much faster than trying ^ at every position
+    anchored = start_reg.startswith("^") and "|" not in start_reg
+    if anchored: block_reg = re.compile("\n" + start_reg[1:], re.MULTILINE)
+    else: block_reg = re.compile(start_reg, re.MULTILINE)
+    entry = None
+    rest = ""
+    while True:
+        block = input_file.read(block_size)
+        buf = "\n" + rest + block
+        if len(block) > 0:
+            # only complete lines are parsed, the partial line is kept
+            end = buf.rfind("\n") + 1
+            buf, rest = buf[:end], buf[end:]
+        pos = 1
+        while pos < len(buf):
+            # find next start line
+            header = None
+            search = pos
+            while search < len(buf):
+                if anchored:
+                    r1 = block_reg.search(buf, search - 1)
+                    if r1 is None: break
+                    line_start = r1.start() + 1
+                else:
+                    r1 = block_reg.search(buf, search)
+                    if r1 is None: break
+                    line_start = buf.rfind("\n", 0, r1.start()) + 1
+                if line_start == len(buf): break
+                line_end = buf.find("\n", line_start) + 1 or len(buf)
+                if line_reg.search(buf[line_start:line_end]) is not None:
+                    header = (line_start, line_end)
+                    break
+                search = line_end
+            region_end = len(buf) if header is None else header[0]
+            # lines before the start line belong to the current entry
+            if entry is not None and region_end > pos:
+                if allow_empty_lines:
+                    entry.append(buf[pos:region_end])
+                else:
+                    r1 = blank_line_reg.search(buf, pos - 1, region_end)
+                    if r1 is not None and r1.start() + 1 < region_end:
+                        entry.append(buf[pos:r1.start() + 1])
+                        yield record_from_text("".join(entry))
+                        entry = None
+                    else:
+                        entry.append(buf[pos:region_end])
+            if header is None: break
+            if entry is not None: yield record_from_text("".join(entry))
+            entry = [buf[header[0]:header[1]]]
+            pos = header[1]
+        if len(block) == 0: break
+
+    # ensure we catch the last entry as well
+    if entry is not None: yield record_from_text("".join(entry))
+
+def __iter_text_lines(input_file, start_reg, allow_empty_lines):
+    """ line by line version of iter_from_text """
     entry = None
     for l in input_file:
         r1 = re.search(start_reg, l)
@@ -163,46 +1499,144 @@ def build_from_text(input_file, start_reg="^#[ \t]+[\w]+",
             if entry is None:
                 entry = [l]
             else:
-                entries.append("".join(entry))
+                yield record_from_text("".join(entry))
                 entry = [l]
         elif entry is not None:
             # if empty line, then end this entry
             if not allow_empty_lines and len(l.strip())==0:
-                entries.append("".join(entry))
+                yield record_from_text("".join(entry))
                 entry = None
             else:
                 entry.append(l)
 
     # ensure we catch the last entry as well
     if entry is not None:
-        entries.append("".join(entry))
-
-    # return the result
-    logging.debug("build entries time: %s" % td(start, time.time()))
-    logging.debug("entries built from text: %s" % len(entries))
-    return entries
-                
+        yield record_from_text("".join(entry))
 
 def build_from_json(input_file):
     """ 
     receives file pointer to moquery json input and breaks into entries list
     """
     start = time.time()
-    root = json.load(input_file)
-    logging.debug("json load time: %s" % td(start, time.time()))
+    entries = list(iter_from_json(input_file))
+    logging.debug("build entries time: %s" % td(start, time.time()))
+    logging.debug("entries built from json: %s" % len(entries))
+    return entries
+
+def iter_from_json(input_file, chunk_size=1024*1024):
+    """
+    receives file pointer to moquery json input and incrementally yields 
+    entries.  The 'imdata' array is decoded one element at a time so memory
+    grows with a single record instead of the whole document
+    """
+    stream = _JsonStream(input_file, chunk_size)
+    if stream.peek() != "{":
+        # not a moquery object, let the child builder report the error
+        entries = []
+        __build_json_child(entries, stream.decode())
+        for e in entries: yield e
+        return
+
+    # walk the top level object, streaming imdata and keeping anything else
+    root = {}
+    found_imdata = False
+    stream.expect("{")
+    if stream.peek() == "}": stream.expect("}")
+    else:
+        while True:
+            key = stream.decode()
+            stream.expect(":")
+            if key == "imdata" and stream.peek() == "[":
+                found_imdata = True
+                stream.expect("[")
+                if stream.peek() == "]": stream.expect("]")
+                else:
+                    while True:
+                        c = stream.decode()
+                        logging.debug("c is %s", c)
+                        entries = []
+                        __build_json_child(entries, c, 1)
+                        for e in entries: yield e
+                        if stream.peek() == "]":
+                            stream.expect("]")
+                            break
+                        stream.expect(",")
+            else:
+                root[key] = stream.decode()
+            if stream.peek() == "}": 
+                stream.expect("}")
+                break
+            stream.expect(",")
 
     entries = []
-    start = time.time()
-    if "imdata" in root:
+    if found_imdata: pass
+    elif "imdata" in root:
         for c in root["imdata"]:
-            logging.debug("c is %s"%c)
             __build_json_child(entries, c, 1)
     else:
         __build_json_child(entries, root)
-    
-    logging.debug("build entries time: %s" % td(start, time.time()))
-    logging.debug("entries built from json: %s" % len(entries))
-    return entries
+    for e in entries: yield e
+
+
+class _JsonStream(object):
+    """
+    minimal incremental reader over a json file pointer.  Reads the file in
+    chunks and decodes one value at a time with json.JSONDecoder.raw_decode
+    """
+    whitespace = re.compile("[ \t\n\r]*")
+
+    def __init__(self, input_file, chunk_size):
+        self.input_file = input_file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """ 
+        read next chunk into the buffer, dropping already consumed data.
+        Chunk size grows with the pending data so large values are read in
+        linear time.  Returns False at end of file
+        """
+        if self.eof: return False
+        pending = self.buf[self.pos:]
+        data = self.input_file.read(max(self.chunk_size, len(pending)))
+        if not data:
+            self.eof = True
+            return False
+        self.buf = pending + data
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """ skip whitespace and return next character ("" at end of file) """
+        while True:
+            self.pos = self.whitespace.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf): return self.buf[self.pos]
+            if not self.fill(): return ""
+
+    def expect(self, char):
+        """ consume next non-whitespace character which must be char """
+        c = self.peek()
+        if c != char:
+            raise Exception("invalid json, expected '%s' but found '%s'" % (
+                char, c))
+        self.pos+= 1
+
+    def decode(self):
+        """ decode and return the next json value """
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if not self.fill(): raise
+                continue
+            # scalars ending exactly at the buffer end may be truncated
+            if end == len(self.buf) and self.fill(): continue
+            self.pos = end
+            return obj
 
 
 def __build_json_child(entries, node, depth=0):
@@ -213,25 +1647,25 @@ def __build_json_child(entries, node, depth=0):
             max_depth)
         raise Exception(err)
   
-    entry = []
     keys = list(node.keys())
     if len(keys)!= 1:
         raise Exception("unexpected key count for node: %s" % node)
     
-    logging.debug("keys is type %s"%type(keys))
-    logging.debug("keys is %s"%keys)
+    logging.debug("keys is type %s", type(keys))
+    logging.debug("keys is %s", keys)
         
-    entry.append("# %s\n" % keys[0])
     n = node[keys[0]]
     if "attributes" in n:
         attr = n ["attributes"]
+        attrs = {}
         for a in attr:
-            entry.append('{0:<16}: {1}\n'.format(a, attr[a]))
+            v = attr[a]
+            attrs[sys.intern(a)] = v if type(v) is str else "{0}".format(v)
     else:
         raise Exception("node with no attributes: %s" % node)
 
     # add entry to entries list
-    entries.append("".join(entry))
+    entries.append(Record(sys.intern(keys[0]), attrs))
 
     next_depth = depth+1
     if "children" in n:
@@ -249,22 +1683,38 @@ def build_from_xml(input_file):
     receives file pointer to moquery xml input and breaks into entries list
     """
     start = time.time()
-    tree = ET.parse(input_file)
-    logging.debug("xml ET parse time: %s" % td(start, time.time()))
-    
-    entries = []
-    start = time.time()
-    root = tree.getroot()
-    # the root is generally 'imdata' which we don't need
-    if root.tag == "imdata":
-        for child in root:
-            __build_xml_child(entries, child, 1)
-    else:
-        __build_xml_child(entries, root)
+    entries = list(iter_from_xml(input_file))
     logging.debug("build entries time: %s" % td(start, time.time()))
     logging.debug("entries built from xml: %s" % len(entries))
     return entries
-    
+
+def iter_from_xml(input_file):
+    """
+    receives file pointer to moquery xml input and incrementally yields each
+    entry as soon as its top-level object is closed.  Finished elements are
+    cleared from the tree so memory stays flat regardless of the file size
+    """
+    root = None
+    depth = 0
+    for event, node in ET.iterparse(input_file, events=("start", "end")):
+        if event == "start":
+            if root is None: root = node
+            depth+= 1
+            continue
+        depth-= 1
+        # the root is generally 'imdata' which we don't need, so emit each
+        # child (and its subtree) when it closes and then drop it
+        if root.tag == "imdata":
+            if depth == 1:
+                entries = []
+                __build_xml_child(entries, node, 1)
+                for e in entries: yield e
+                root.clear()
+        elif depth == 0:
+            entries = []
+            __build_xml_child(entries, node)
+            for e in entries: yield e
+
 def __build_xml_child(entries, node, depth=0):
     """ recursive function to grab tags/attrib from all children xml nodes """
     max_depth=10000
@@ -273,335 +1723,811 @@ def __build_xml_child(entries, node, depth=0):
             max_depth)
         raise Exception(err)
 
-    entry = []
-    entry.append("# %s\n" % node.tag)
+    attrs = {}
     for a in node.attrib:
-        entry.append('{0:<16}: {1}\n'.format(a, node.attrib[a]))
-    entries.append("".join(entry))
+        attrs[sys.intern(a)] = node.attrib[a]
+    entries.append(Record(sys.intern(node.tag), attrs))
 
     next_depth = depth+1
     for child in node:
         __build_xml_child(entries, child, next_depth)
     
-def letter_month(whole_string):
+def iter_from_file(input_file, method="moquery", delim=None, 
+        allow_empty_lines=False):
     """
-    this function expects the whole string that is already parsed by entry_parsed
+    receives file pointer and returns an iterable of entries built with the
+    provided method (moquery, text, xml, or json).  Formats that support
+    incremental parsing are returned as generators
     """
-    letter_date = ""
-    month = ""
-    new_month = ""
-    date_reg = re.compile("^20[0-5][0-9]-[0-1][0-9]-[0-3][0-9]")    
-
-    # get the date_string from the whole_string
-    date_string = re.search(date_reg, whole_string)
-    if date_string:
-       date_string = date_string.group(0)
-    else:
-        return whole_string    
-
-    # get the two digit month from the date_string
-    month = date_string[5:7]
-    
-    if month == "01": new_month = "Jan"
-    if month == "02": new_month = "Feb"
-    if month == "03": new_month = "Mar"
-    if month == "04": new_month = "Apr"
-    if month == "05": new_month = "May"
-    if month == "06": new_month = "Jun"
-    if month == "07": new_month = "Jul"
-    if month == "08": new_month = "Aug"
-    if month == "09": new_month = "Sep"
-    if month == "10": new_month = "Oct"
-    if month == "11": new_month = "Nov"
-    if month == "12": new_month = "Dec"
-    
-    letter_date = date_string[0:4] + " " + new_month + " " + date_string[8:10] + " "
-    
-    out_string = letter_date + whole_string[11:]    
-
-    return out_string
-
-
-def event_entry_parse(input_file, full_option):
+    if method == "moquery": return iter_from_text(input_file)
+    elif method == "text": 
+        return iter_from_text(input_file, delim, allow_empty_lines)
+    elif method == "xml": return iter_from_xml(input_file)
+    elif method == "json": return iter_from_json(input_file)
+    raise Exception("invalid method: %s" % method)
+
+# magic bytes of supported compressed formats: (magic, format, module)
+compression_magic = (
+    (b"\x1f\x8b", "gzip", gzip), 
+    (b"BZh", "bz2", bz2), 
+    (b"\xfd7zXZ\x00", "xz", lzma),
+)
+
+def __decompressor(magic, name):
     """
-    parse each entry and return the list of new entries, use STDIN
-
+    return module used to decompress data starting with magic bytes, or 
+    None if it is not compressed
     """
-    out_list = []
-
-    created_reg = re.compile("(?<=created\s{9}:\s).*")
-    severity_reg = re.compile("(?<=severity\s{8}:\s).*")
-    affected_reg = re.compile("(?<=affected\s{8}:\s).*")
-    trig_reg = re.compile("(?<=trig\s{12}:\s).*")
-    descr_reg = re.compile("(?<=descr\s{11}:\s).*")
-    changeSet_reg = re.compile("(?<=changeSet\s{7}:\s).*")
-    
-    created = ""
-    severity = ""
-    trig = ""
-    affected = ""
-    descr = ""
-    changeSet = ""
-
-    for item in input_file:
-        for line in item[0].splitlines() if isinstance(item,list) else item.splitlines():
-            if "# eventRecord" in line: 
-                created = "unknown"
-                severity = "unknown"
-                trig = "unknown"
-                affected = "unknown"
-                descr = "unknown"
-                changeSet = "unknown"
-                continue
-            if "created" in line:                
-                this = re.search(created_reg, line)
-                if this:
-                    created_pre = this.group(0)
-                    created = created_pre[0:10] + " " + created_pre[11:23]
-            if "severity" in line:
-                this = re.search(severity_reg, line)
-                if this: severity = this.group(0)
-            if "trig" in line:
-                this = re.search(trig_reg, line)
-                if this: trig = this.group(0)
-            if "affected" in line:
-                this = re.search(affected_reg, line)
-                if this:
-                    if full_option:
-                        affected = this.group(0)
-                    else:
-                        affected = this.group(0)
-                        if len(affected) >= 40:
-                            affected = "..." + affected[:40]
-            if "descr" in line:
-                this = re.search(descr_reg, line)
-                if this: descr = this.group(0)
-            if "changeSet" in line:
-                this = re.search(changeSet_reg, line)
-                if this.group(0).strip(): changeSet = this.group(0) 
-        
-        out_line = "%s %s %s %%%s: \"\"%s\"\"" %(created, severity, trig, affected, descr)
-        if changeSet.strip() != "unknown": out_line = out_line + " == " + changeSet
-        out_list.append(out_line)
+    for m, fmt, module in compression_magic:
+        if magic.startswith(m):
+            if module is None:
+                raise Exception("%s is %s compressed but python was built "
+                    "without %s support" % (name, fmt, fmt))
+            return module
+    return None
+
+def open_input(path):
+    """
+    open input file for reading as text.  gzip, bz2 and xz compressed files
+    are detected from their magic bytes and decompressed as they are read
+    """
+    with open(path, "rb") as f: magic = f.read(6)
+    module = __decompressor(magic, path)
+    if module is None: return open(path, "r")
+    logging.debug("decompressing %s with %s" % (path, module.__name__))
+    return module.open(path, "rt")
 
-    return out_list
+def open_stream(stream):
+    """
+    return text stream (such as stdin) decompressing its data if it is 
+    gzip, bz2 or xz compressed, otherwise stream is returned as is
+    """
+    buf = getattr(stream, "buffer", None)
+    if buf is None or not hasattr(buf, "peek"): return stream
+    module = __decompressor(buf.peek(6)[:6], getattr(stream, "name", 
+        "input"))
+    if module is None: return stream
+    logging.debug("decompressing input with %s" % module.__name__)
+    return io.TextIOWrapper(module.open(buf, "rb"))
+
+def iter_file(path, method="moquery", delim=None, allow_empty_lines=False):
+    """
+    open a single input file and yield its entries as they are parsed
+    """
+    with open_input(path) as f:
+        for e in iter_from_file(f, method, delim, allow_empty_lines):
+            yield e
 
+def parse_file(path, method="moquery", delim=None, allow_empty_lines=False):
+    """
+    open and fully parse a single input file returning its entries list
+    """
+    return list(iter_file(path, method, delim, allow_empty_lines))
 
-def aaa_entry_parse(input_file, full_option):
+def load_file(path, method="moquery", delim=None, allow_empty_lines=False,
+        cache=None):
+    """
+    return entries for a single input file.  When a ParseCache is provided
+    a cached Snapshot is returned if available, otherwise the file is parsed
+    and written to the cache as it is read
     """
-    parse each entry and return the list of new entries, use STDIN
+    if cache is not None:
+        return cache.entries(path, method, delim, allow_empty_lines)
+    return iter_file(path, method, delim, allow_empty_lines)
 
+class ParseCache(object):
+    """
+    on-disk cache of parsed input files stored as snapshots.  Each file is
+    keyed by its path, size, mtime and content hash along with the parse 
+    options.  The cache directory is bounded to max_size bytes by evicting
+    the least recently used snapshots
+    """
+    def __init__(self, directory=None, max_size=1024*1024*1024):
+        if directory is None:
+            directory = os.environ.get("SECTION_PARSER_CACHE",
+                os.path.join(os.path.expanduser("~"), ".cache", 
+                "section_parser"))
+        self.directory = directory
+        self.max_size = max_size
+
+    def key(self, path, method, delim, allow_empty_lines):
+        """ cache key for input file and parse options """
+        st = os.stat(path)
+        content = hashlib.sha1()
+        with open(path, "rb") as f:
+            while True:
+                block = f.read(1024*1024)
+                if not block: break
+                content.update(block)
+        ident = [os.path.abspath(path), st.st_size, st.st_mtime_ns, 
+            content.hexdigest(), method, delim, allow_empty_lines, 
+            SNAPSHOT_MAGIC.decode()]
+        return hashlib.sha1(json.dumps(ident).encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, "%s.snap" % key)
+
+    def get(self, key):
+        """ return cached Snapshot for key or None on a miss """
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                snapshot = Snapshot(f)
+            # refresh mtime for least recently used eviction
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        except Exception as e:
+            logging.warning("ignoring invalid cache file %s: %s" % (path, e))
+            return None
+        logging.debug("cache hit: %s" % path)
+        return snapshot
+
+    def entries(self, path, method, delim, allow_empty_lines):
+        """
+        return cached Snapshot for the input file or a generator parsing 
+        the file and writing it to the cache as it goes
+        """
+        key = self.key(path, method, delim, allow_empty_lines)
+        snapshot = self.get(key)
+        if snapshot is not None: return snapshot
+        return self._write_through(key, 
+            iter_file(path, method, delim, allow_empty_lines))
+
+    def store(self, path, method, delim, allow_empty_lines):
+        """
+        ensure input file is cached and return its snapshot path, or None if
+        it could not be written
+        """
+        key = self.key(path, method, delim, allow_empty_lines)
+        if os.path.isfile(self.path(key)):
+            os.utime(self.path(key), None)
+            return self.path(key)
+        for e in self._write_through(key, 
+            iter_file(path, method, delim, allow_empty_lines)): pass
+        if os.path.isfile(self.path(key)): return self.path(key)
+        return None
+
+    def _write_through(self, key, entries):
+        """
+        yield entries while writing them to a temporary snapshot which is 
+        moved into the cache once all entries are consumed.  Cache write
+        failures are logged and entries are still yielded
+        """
+        tmp = "%s.%d.tmp" % (self.path(key), os.getpid())
+        writer = None
+        try:
+            try:
+                if not os.path.isdir(self.directory):
+                    os.makedirs(self.directory)
+                writer = SnapshotWriter(open(tmp, "wb"))
+            except (IOError, OSError) as e:
+                logging.warning("unable to write cache: %s" % e)
+            for e in entries:
+                if writer is not None: writer.add(e)
+                yield e
+            if writer is not None:
+                writer.close()
+                writer.output.close()
+                os.rename(tmp, self.path(key))
+                writer = None
+                self.evict()
+        finally:
+            # incomplete read (error or early stop), discard partial cache
+            if writer is not None:
+                writer.output.close()
+                try: os.unlink(tmp)
+                except OSError: pass
+
+    def evict(self):
+        """ remove least recently used snapshots above max_size """
+        files = []
+        total = 0
+        for f in os.listdir(self.directory):
+            if not f.endswith(".snap"): continue
+            path = os.path.join(self.directory, f)
+            try: st = os.stat(path)
+            except OSError: continue
+            # index sidecar (see EntryIndex) is evicted with its snapshot
+            size = st.st_size
+            try: size+= os.path.getsize("%s.idx" % path)
+            except OSError: pass
+            files.append((st.st_mtime, path, size))
+            total+= size
+        files.sort()
+        while total > self.max_size and len(files) > 1:
+            mtime, path, size = files.pop(0)
+            for p in (path, "%s.idx" % path):
+                try: os.unlink(p)
+                except OSError: pass
+            logging.debug("cache evicted: %s" % path)
+            total-= size
+
+def __parse_file_job(job):
+    """
+    worker process wrapper for parse_file, job is an args tuple plus the
+    ParseCache (or None).  When caching, the file is written to the cache 
+    and its snapshot path is returned instead of the entries
+    """
+    path, method, delim, allow_empty_lines, cache = job
+    if cache is not None:
+        snapshot_path = cache.store(path, method, delim, allow_empty_lines)
+        if snapshot_path is not None: return snapshot_path
+    return parse_file(path, method, delim, allow_empty_lines)
+
+def iter_parallel(paths, jobs, method="moquery", delim=None, 
+        allow_empty_lines=False, cache=None):
     """
-    out_list = []
+    parse each file in paths within a pool of 'jobs' worker processes and
+    yield all entries in the same order as a serial parse of the files.
+    Each file's entries are yielded as soon as that file (and all files
+    before it) have been parsed.  With a ParseCache, workers write the 
+    parsed files to the cache and the snapshots are read from there
+    """
+    for entries in iter_parallel_files(paths, jobs, method, delim, 
+        allow_empty_lines, cache):
+        for e in entries: yield e
 
-    created_reg = re.compile("(?<=created\s{9}:\s).*")
-    user_reg = re.compile("(?<=user\s{12}:\s).*")
-    affected_reg = re.compile("(?<=affected\s{8}:\s).*")
-    descr_reg = re.compile("(?<=descr\s{11}:\s).*")
-    changeSet_reg = re.compile("(?<=changeSet\s{7}:\s).*")
-    
-    created = ""
-    user = ""
-    affected = ""
-    descr = ""
-    changeSet = ""
+def iter_parallel_files(paths, jobs, method="moquery", delim=None, 
+        allow_empty_lines=False, cache=None):
+    """
+    same as iter_parallel but yields the entries of each file separately
+    (as a list or Snapshot) in the order of paths
+    """
+    import multiprocessing
+    start = time.time()
+    pool = multiprocessing.Pool(min(jobs, len(paths)))
+    try:
+        work = [(p, method, delim, allow_empty_lines, cache) for p in paths]
+        for entries in pool.imap(__parse_file_job, work):
+            if isinstance(entries, str):
+                with open(entries, "rb") as f:
+                    entries = Snapshot(f)
+            yield entries
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    logging.debug("parallel build time (%d jobs): %s" % (jobs, 
+        td(start, time.time())))
 
-    for item in input_file:
-        for line in item[0].splitlines() if isinstance(item,list) else item.splitlines():
-            if "# aaaModLR" in line:
-                created = "unknown"
-                user = "unknown"
-                affected = "unknown"
-                descr = "unknown"
-                changeSet = "unknown"
+def iter_merged(sources, attr="created", order="desc"):
+    """
+    k-way merge of entry sources that are each already sorted on attribute(s)
+    attr in the given order ('asc' or 'desc'), such as pages collected with
+    order-by=<class>.created|desc.  Entries are yielded as they are read 
+    and only one pending entry per source is held in memory.  Entries with
+    no value for attr sort as the lowest value (see typed_value)
+    """
+    reverse = order == "desc"
+    key = sort_key_func(attr)
+
+    streams = [__check_order(s, key, reverse, attr) for s in sources]
+    return heapq.merge(*streams, key=key, reverse=reverse)
+
+def __check_order(entries, key, reverse, attr):
+    """ yield entries and warn if they are not sorted as expected """
+    last = None
+    warned = False
+    for e in entries:
+        if not warned:
+            k = key(e)
+            if last is not None and ((k > last) if reverse else (k < last)):
+                logging.warning("input not sorted on %s (%s), merged output"
+                    " may be out of order" % (attr, "desc" if reverse else "asc"))
+                warned = True
+            last = k
+        yield e
+
+def iter_dedup(entries, key="dn"):
+    """
+    yield entries skipping repeats of the value of attribute(s) key (list
+    or comma separated string), such as records shifted across pages 
+    collected while the fabric keeps logging.  The first occurrence is kept
+    and entries missing the key are always yielded.  Only the 64-bit hash
+    of each key is kept in memory, a collision (odds of a few in a million
+    over 10^7 distinct keys) would drop an entry
+    """
+    attrs = split_sort_attrs(key)
+    if len(attrs) == 0: raise Exception("invalid dedup key: %s" % key)
+    seen = set()
+    duplicates = 0
+    for e in entries:
+        values = e.attrs
+        if len(attrs) == 1: 
+            k = values.get(attrs[0])
+        else:
+            k = tuple([values.get(a) for a in attrs])
+            if all(v is None for v in k): k = None
+        if k is None: 
+            yield e
+            continue
+        h = hash(k)
+        if h in seen:
+            duplicates+= 1
+            continue
+        seen.add(h)
+        yield e
+    logging.debug("dedup on %s, duplicates: %d, keys: %d" % (",".join(attrs),
+        duplicates, len(seen)))
+    stats.count("duplicates", duplicates)
+
+class FollowState(object):
+    """
+    newest created timestamp and id emitted per record class, kept in a 
+    json state file between runs so each run only yields records newer than
+    those emitted by the previous one (--follow).  iter_new drops the 
+    records already seen and iter_emitted records the ones printed.  
+    Entries without a created timestamp are skipped.  Entries with the same
+    created are ordered on their id
+
+    query holds the options filtering the printed entries.  Entries they
+    filter out are older than the checkpoint once a newer entry is printed,
+    so the state file can only be reused with the same filters
+    """
+    def __init__(self, path, query=None):
+        self.path = path
+        self.query = query or {}
+        self.checkpoints = {}
+        self.skipped = 0
+        if os.path.exists(path):
+            try:
+                with open(path, "r") as f:
+                    state = json.load(f)
+                for cls, cp in state["classes"].items():
+                    cp = self._checkpoint(cp["created"], cp.get("id"))
+                    if cp is not None: self.checkpoints[cls] = cp
+                saved = state.get("query") or {}
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                raise Exception("invalid follow state file %s: %s" % (
+                    path, e))
+            if saved != self.query:
+                raise Exception("follow state file %s was written with "
+                    "other filters (%s), use a separate state file per "
+                    "filter" % (path, json.dumps(saved)))
+        self.newest = dict(self.checkpoints)
+        logging.debug("follow checkpoints: %s" % ", ".join("%s %s" % (
+            c, self.checkpoints[c][2]) for c in self.checkpoints))
+
+    def _checkpoint(self, created, rid):
+        """ (created ms, numeric id, created, id) of a record """
+        ms = parse_timestamp(created) if created else None
+        if ms is None: return None
+        num = int(rid) if rid is not None and integer_reg.match(rid) else -1
+        return (ms, num, created, rid)
+
+    def iter_new(self, entries, order=None):
+        """
+        yield entries newer than the checkpoint of their class.  With order
+        'desc' (entries ordered on created desc, one class per source) 
+        reading stops at the first entry older than its checkpoint
+        """
+        checkpoints = self.checkpoints
+        for e in entries:
+            attrs = e.attrs
+            cp = self._checkpoint(attrs.get("created"), attrs.get("id"))
+            if cp is None:
+                self.skipped+= 1
                 continue
-            if "created" in line:                
-                this = re.search(created_reg, line)
-                if this:
-                    created_pre = this.group(0)
-                    created = created_pre[0:10] + " " + created_pre[11:23]
-            if "user" in line:
-                this = re.search(user_reg, line)
-                if this: user = this.group(0)
-            if "affected" in line:
-                this = re.search(affected_reg, line)
-                if this:
-                    if full_option:
-                        affected = this.group(0)
-                    else:
-                        affected = this.group(0)
-                        if len(affected) >= 50:
-                            affected = affected[:50] + "..."
-            if "descr" in line:
-                this = re.search(descr_reg, line)
-                if this: descr = this.group(0)
-            if "changeSet" in line:
-                this = re.search(changeSet_reg, line)
-                if this.group(0).strip(): changeSet = this.group(0) 
-            
-        out_line = "%s %s %%%s: \"\"%s\"\"" %(created, user.strip("remote_user-"), affected, descr)
-        if changeSet.strip() != "unknown": out_line = out_line + " == " + changeSet
-        out_list.append(out_line)
-        
-    return out_list
-
+            last = checkpoints.get(e.cls)
+            if last is not None and cp[0:2] <= last[0:2]:
+                if order == "desc" and cp[0] < last[0]: 
+                    logging.debug("follow reached %s checkpoint %s" % (
+                        e.cls, last[2]))
+                    return
+                continue
+            yield e
 
-def fault_entry_parse(input_file, full_option, del_option):
+    def iter_emitted(self, entries):
+        """ yield entries, recording the newest of each class as emitted """
+        newest = self.newest
+        for e in entries:
+            attrs = e.attrs
+            cp = self._checkpoint(attrs.get("created"), attrs.get("id"))
+            if cp is not None:
+                top = newest.get(e.cls)
+                if top is None or cp[0:2] > top[0:2]: newest[e.cls] = cp
+            yield e
+
+    def save(self):
+        """ atomically replace the state file with the newest checkpoints """
+        state = {"classes": dict((cls, {"created": cp[2], "id": cp[3]}) 
+            for cls, cp in sorted(self.newest.items())), "query": self.query}
+        tmp = "%s.%d.tmp" % (self.path, os.getpid())
+        try:
+            with open(tmp, "w") as f:
+                json.dump(state, f, indent=1, sort_keys=True)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+        except (IOError, OSError) as e:
+            try: os.unlink(tmp)
+            except OSError: pass
+            raise Exception("unable to write follow state %s: %s" % (
+                self.path, e))
+        if self.skipped > 0:
+            logging.debug("follow skipped %d entries without created" % (
+                self.skipped))
+        logging.debug("follow state saved: %s" % self.path)
+
+# fault classes whose records in deletion state are suppressed by retro
+retro_deletion_classes = ("faultRecord", "faultInst")
+
+def __retro_created(created):
+    """ created timestamp in retro format '2020-05-29 16:30:45.066' """
+    if created is None: return "unknown"
+    return created[0:10] + " " + created[11:23]
+
+def __retro_user(user):
+    """ user with remote_user- prefix removed """
+    if user is None: user = "unknown"
+    return user.strip("remote_user-")
+
+def __retro_layouts(full_option):
     """
-    parse each entry and return the list of new entries, use STDIN
-
+    build the retro layout table: record class -> (format string, field 
+    specs).  Each field spec is (attribute, conversion) 
+    and conversion is applied to the raw value (None if missing).  Fields
+    without conversion default to 'unknown'
     """
-    out_list = []
-
-    created_reg = re.compile("(?<=created\s{9}:\s).*")
-    code_reg = re.compile("(?<=code\s{12}:\s).*")
-    o_severity_reg = re.compile("(?<=origSeverity\s{4}:\s).*")
-    severity_reg = re.compile("(?<=severity\s{8}:\s).*")
-    affected_reg = re.compile("(?<=affected\s{8}:\s).*")
-    lc_reg = re.compile("(?<=lc\s{14}:\s).*")
-    ind_reg = re.compile("(?<=ind\s{13}:\s).*")
-    descr_reg = re.compile("(?<=descr\s{11}:\s).*")
-    changeSet_reg = re.compile("(?<=changeSet\s{7}:\s).*")
-    
-    code = ""
-    created = ""
-    o_severity = ""
-    severity = ""
-    lc = ""
-    affected = ""
-    descr = ""
-    changeSet = ""
-    ind = ""
+    def affected_prefix(affected):
+        if affected is None: return "unknown"
+        if not full_option and len(affected) >= 40:
+            return "..." + affected[:40]
+        return affected
+
+    def affected_suffix(affected):
+        if affected is None: return "unknown"
+        if not full_option and len(affected) >= 50:
+            return affected[:50] + "..."
+        return affected
+
+    fault = ("%s %s '%s' %s/%s %%%s: \"\"%s\"\"", (
+        ("created", __retro_created), ("code", None), ("lc", None), 
+        ("origSeverity", None), ("severity", None), 
+        ("affected", affected_prefix), ("descr", None),
+    ))
+    return {
+        "aaaModLR": ("%s %s %%%s: \"\"%s\"\"", (
+            ("created", __retro_created), ("user", __retro_user), 
+            ("affected", affected_suffix), ("descr", None),
+        )),
+        "eventRecord": ("%s %s %s %%%s: \"\"%s\"\"", (
+            ("created", __retro_created), ("severity", None), ("trig", None),
+            ("affected", affected_prefix), ("descr", None),
+        )),
+        "faultRecord": fault,
+        "faultInst": fault,
+    }
+
+def retro_suppressed(item):
+    """
+    return True if retro output drops this record unless --deletion is set
+    (faults in deletion state)
+    """
+    return (item.cls in retro_deletion_classes and 
+        item.attrs.get("ind") == "deletion")
 
+def retro_entry_parse(input_file, full_option=False, del_option=False,
+        records=False):
+    """
+    parse each entry and yield the new one line entry.  The layout is 
+    chosen per record from its class (aaaModLR, eventRecord, faultRecord) 
+    and each record's fields are extracted in a single pass.  Records of 
+    other classes are returned unchanged.  With records set, (record, line)
+    tuples are yielded instead
+    """
+    layouts = __retro_layouts(full_option)
+    unknown = set()
     for item in input_file:
-        for line in item[0].splitlines() if isinstance(item,list) else item.splitlines():
-            if ("# faultRecord" in line) or ("# faultInst" in line): 
-                code = "unknown"
-                created = "unknown"
-                o_severity = "unknown"
-                severity = "unknown"
-                lc = "unknown"
-                affected = "unknown"
-                descr = "unknown"
-                changeSet = "unknown"
-                ind = "unknown"
-                continue
-            if "created" in line:                
-                this = re.search(created_reg, line)
-                if this:
-                    created_pre = this.group(0)
-                    created = created_pre[0:10] + " " + created_pre[11:23]
-            if "ind   " in line:
-                this = re.search(ind_reg, line)
-                if this: ind = this.group(0)
-            if "code  " in line:
-                this = re.search(code_reg, line)
-                if this: code = this.group(0)
-            if "origSeverity" in line:
-                this = re.search(o_severity_reg, line)
-                if this:  o_severity = this.group(0)
-            if "severity  " in line:
-                this = re.search(severity_reg, line)
-                if this: severity = this.group(0)
-            if "lc  " in line:
-                this = re.search(lc_reg, line)
-                if this: lc = this.group(0)
-            if "affected  " in line:
-                this = re.search(affected_reg, line)
-                if this:
-                    if full_option:
-                        affected = this.group(0)
-                    else:
-                        affected = this.group(0)
-                        if len(affected) >= 40:
-                            affected = "..." + affected[:40]
-            if "descr  " in line:
-                this = re.search(descr_reg, line)
-                if this: descr = this.group(0)
-            if "changeSet" in line:
-                this = re.search(changeSet_reg, line)
-                if this.group(0).strip(): changeSet = this.group(0) 
-        
-        out_line = "%s %s '%s' %s/%s %%%s: \"\"%s\"\"" %(created, code, lc, o_severity, severity, affected, descr)
-        if changeSet.strip() != "unknown": out_line = out_line + " == " + changeSet
-        if del_option:
-            out_list.append(out_line)
-        else:
-            if not ind=="deletion":
-                out_list.append(out_line)
-        
-    return out_list
-
-
-def space_option(input_list):
+        layout = layouts.get(item.cls)
+        if layout is None:
+            if item.cls not in unknown:
+                unknown.add(item.cls)
+                logging.error("Unable to Determine Record Type: %s" % item.cls)
+            yield (item, item.text()) if records else item.text()
+            continue
+        if not del_option and retro_suppressed(item): continue
+        fmt, fields = layout
+        attrs = item.attrs
+        out_line = fmt % tuple([
+            attrs.get(a, "unknown") if conv is None else conv(attrs.get(a))
+            for a, conv in fields
+        ])
+        changeSet = attrs.get("changeSet")
+        if changeSet is not None:
+            c = changeSet.strip()
+            if c and c != "unknown": out_line = out_line + " == " + changeSet
+        yield (item, out_line) if records else out_line
+
+
+def space_option(input_list, gap=3):
     """
     add a grouping option to make it easier to read discern the difference between user input and
     automated input the thought is that a user cannot do anything subsecond, so any aaa logs that
-    are >1 must be a part of another action I'm just comparing the minutes and seconds so there
-    would be scenarios where commands run on different dates at the exact same second would appear
-    as one entry, but that seems like a rare occurance 
-    """   
-    out_list = []
-    last_time = 235959  # by using a decimal, we can just compare and see if the difference is >2 (seconds)
-    this_time = 235959
-    time_reg = re.compile("(?<=^20[0-5][0-9]-[0-1][0-9]-[0-3][0-9]\s)[0-2][0-9]:[0-5][0-9]:[0-5][0-9]")
-    first_time = True
-    spacing_time = 3  # time in seconds we need to not see a log to create a space
-
-    for line in input_list:
-        this_time = re.search(time_reg, line)
-        if this_time:
-            this_time = int(this_time.group(0).replace(":", ""))
-        if not first_time:
-            if abs(this_time-last_time) >= spacing_time:
-                out_list.append("")
-        out_list.append(line )
-        if first_time: first_time = False
-        last_time = this_time
-    
-    return out_list
-
+    are >1 must be a part of another action.  input_list holds (record, line) tuples (see 
+    retro_entry_parse) and an empty line is added whenever the created time of consecutive 
+    records differs by gap seconds or more.  Records without a created time are not spaced
+    """
+    gap_ms = gap * 1000
+    last_time = None
+    for item, line in input_list:
+        this_time = entry_time(item)
+        if this_time is not None:
+            if last_time is not None and abs(this_time - last_time) >= gap_ms:
+                yield ""
+            last_time = this_time
+        yield line
+
+
+month_date_reg = re.compile("^20[0-5][0-9]-[0-1][0-9]-[0-3][0-9]")
+month_names = {"01": "Jan", "02": "Feb", "03": "Mar", "04": "Apr", 
+    "05": "May", "06": "Jun", "07": "Jul", "08": "Aug", "09": "Sep", 
+    "10": "Oct", "11": "Nov", "12": "Dec"}
 
 def letter_month(whole_string):
+    """
+    this function expects the whole string that is already parsed by 
+    entry_parsed and converts the leading 2020-05-29 date to 2020 May 29
+    """
+    if month_date_reg.match(whole_string) is None: return whole_string
+    return "%s %s %s %s" % (whole_string[0:4], 
+        month_names.get(whole_string[5:7], ""), whole_string[8:10], 
+        whole_string[11:])
+
+def positive_int(value):
+    """ parse integer greater than 0, raises ValueError otherwise """
+    n = int(value)
+    if n <= 0: raise ValueError("not a positive integer: %s" % value)
+    return n
+
+def add_search_arguments(parser):
+    """
+    add the search, sort and retro options to an argparse parser.  Shared by
+    the command line and by --serve queries, see run_query
+    """
+    parser.add_argument("-r", "--regex", action="append", dest="regex",
+        help="print all entries that match search regex.  Can be repeated "
+        "to print entries matching any of the regexes")
+    parser.add_argument("--patterns-file", action="store", 
+        dest="patterns_file", metavar="FILE", help="file with one search "
+        "regex per line, entries matching any of them (or any -r regex) are "
+        "printed")
+    parser.add_argument("--negative", action="store_true", dest="nregex",
+        help="print all entries that do not match search regex")
+    parser.add_argument("-i", "--ignore-case", action="store_true", 
+        dest="ignore_case", help="case insensitive search")
+    parser.add_argument("--where", action="append", dest="where",
+        type=parse_where, metavar="ATTR=VALUE", help="print only entries "
+        "whose attribute equals value, or starts with value ending in '*' "
+        "(ex: code=F0532, dn=topology/pod-1/*).  Can be repeated, entries "
+        "must match all.  Restored and cached snapshots keep an index of "
+        "the attribute")
+    parser.add_argument("--under", action="store", dest="under",
+        metavar="DN", help="print only entries whose dn or affected object "
+        "(or a dn nested within them) is DN or below it (ex: uni/tn-A/ap-A,"
+        " topology/pod-1/paths-102)")
+    parser.add_argument("--since", action="store", dest="since", 
+        type=parse_time, metavar="TIME", help="print only entries created "
+        "at or after TIME, either a timestamp (ex: 2020-05-29T13:50:00, UTC"
+        " unless an offset is given) or a duration before now (ex: 30m, 2h,"
+        " 1d).  With --input-order, reading a file stops once its entries "
+        "are past the window")
+    parser.add_argument("--until", action="store", dest="until", 
+        type=parse_time, metavar="TIME", help="print only entries created "
+        "at or before TIME, see --since")
+    parser.add_argument("--sort", action="store", dest="sort",
+        help="sort results based on provided attribute, multiple attributes"
+        " can be comma separated (ex: created,id).  Timestamps and integers"
+        " are sorted on their value")
+    parser.add_argument("--sortr", action="store", dest="sortr",
+        help="sort results based on value matched from provided regex")
+    limit_group = parser.add_mutually_exclusive_group()
+    limit_group.add_argument("--limit", action="store", type=positive_int,
+        dest="limit", metavar="N", help="print only the first N results. "
+        "Without --sort, input is no longer read once N results are printed")
+    limit_group.add_argument("--tail", action="store", type=positive_int,
+        dest="tail", metavar="N", help="print only the last N results")
+    parser.add_argument("--group-by", action="store", dest="group_by",
+        metavar="ATTR[,ATTR]", help="print the count and first and last "
+        "created of each group of entries with the same attribute values "
+        "(ex: code,severity) instead of the entries, most frequent first")
+    parser.add_argument("--bucket", action="store", dest="bucket",
+        type=positive_duration, metavar="DURATION", help="group entries on "
+        "their created time in buckets of DURATION (ex: 1h, 15m, 1d, UTC "
+        "aligned), alone or with --group-by")
+    parser.add_argument("--retro", action="store_true", dest="retro_option",
+        help="retro argument, will auto-detect aaa, fault, or event")
+    parser.add_argument("--space", action="store_true", dest="retro_space",
+        help="space argument for retro, adds a space after 3 seconds of inactivity, see --space-gap")
+    parser.add_argument("--space-gap", action="store", dest="retro_space_gap",
+        type=parse_duration, default=3, metavar="DURATION",
+        help="inactivity between records that adds a space with --space (ex: 500ms, 5s, 1m, default 3s)")
+    parser.add_argument("--month", action="store_true", dest="retro_month",
+        help="converts the month from a number into a 3 letter abbreviation")
+    parser.add_argument("--full", action="store_true", dest="retro_full",
+        help="prints the full output, default is only 40 characters")
+    parser.add_argument("--deletion", action="store_true", dest="retro_deletion",
+        help="option to print faults that are in deletion state, which are suppressed by default")
 
-    letter_date = ""
-    month = ""
-    new_month = ""
-    date_reg = re.compile("^20[0-5][0-9]-[0-1][0-9]-[0-3][0-9]")    
+def run_query(entries, args, output=None, presorted=False, index=None, 
+        jobs=1, follow=None):
+    """
+    run search_entries with the options parsed by add_search_arguments.  
+    presorted entries (merged inputs) keep their order and the sort options
+    are ignored.  index is an optional EntryIndex of entries, jobs the 
+    number of processes used for the regex filter and follow the optional
+    FollowState recording the printed entries
+    """
+    # sort on attribute value or on value matched by user provided regex
+    sortr = None
+    if args.sortr is not None and args.sort is None and not presorted:
+        sortr = "(?P<m>%s)" % args.sortr
+    sort_attr = None if presorted else args.sort
+    patterns = list(args.regex or [])
+    if args.patterns_file is not None: 
+        patterns.extend(load_patterns(args.patterns_file))
+    # without regex all entries are printed with user's sort option
+    search_entries(entries, patterns or None, args.ignore_case, sortr,
+        args.nregex, args.retro_option, args.retro_space, args.retro_month, 
+        args.retro_full, args.retro_deletion, sort_attr, output, 
+        limit=args.limit, tail=args.tail, where=args.where, index=index, 
+        under=args.under, since=args.since, until=args.until, 
+        retro_space_gap=args.retro_space_gap, jobs=jobs, 
+        group_by=args.group_by, bucket=args.bucket, follow=follow)
+
+def follow_query(args):
+    """ 
+    options filtering the printed entries, saved with the --follow state.
+    The --since/--until window is left out, entries past --until are newer
+    than the checkpoint and entries before --since are not wanted
+    """
+    patterns = list(args.regex or [])
+    if args.patterns_file is not None: 
+        patterns.extend(load_patterns(args.patterns_file))
+    query = {"regex": patterns, "negative": args.nregex, 
+        "ignore_case": args.ignore_case, "under": args.under, 
+        "where": [list(w) for w in args.where or []], 
+        "suppress_deletion": args.retro_option and not args.retro_deletion}
+    return dict((k, v) for k, v in query.items() if v)
+
+def load_patterns(path):
+    """ 
+    list of regexes from file with one regex per line.  Raises ValueError 
+    if the file holds none, a search for nothing is not a search for all
+    """
+    with open_input(path) as f:
+        patterns = [l.rstrip("\r\n") for l in f 
+            if len(l.rstrip("\r\n")) > 0]
+    if len(patterns) == 0: raise ValueError("no patterns in %s" % path)
+    return patterns
 
-    # get the date_string from the whole_string
-    date_string = re.search(date_reg, whole_string)
-    if date_string:
-       date_string = date_string.group(0)
-    else:
-        return whole_string    
+class QueryError(Exception):
+    """ raised for a query that cannot be parsed """
+    pass
 
-    # get the two digit month from the date_string
-    month = date_string[5:7]
-    
-    if month == "01": new_month = "Jan"
-    if month == "02": new_month = "Feb"
-    if month == "03": new_month = "Mar"
-    if month == "04": new_month = "Apr"
-    if month == "05": new_month = "May"
-    if month == "06": new_month = "Jun"
-    if month == "07": new_month = "Jul"
-    if month == "08": new_month = "Aug"
-    if month == "09": new_month = "Sep"
-    if month == "10": new_month = "Oct"
-    if month == "11": new_month = "Nov"
-    if month == "12": new_month = "Dec"
-    
-    letter_date = date_string[0:4] + " " + new_month + " " + date_string[8:10] + " "
-    
-    out_string = letter_date + whole_string[11:]    
+class QueryServer(object):
+    """
+    holds entries in memory and answers queries against them so input is
+    only parsed once.  A query is a line holding the same search options as
+    the command line (ex: -r admin --sort created --retro), see 
+    add_search_arguments.  Queries are read from stdin (repl) or from 
+    clients connecting to a unix socket (serve), one query per connection
+    """
+    def __init__(self, entries, jobs=1):
+        import argparse
 
-    return out_string
+        class QueryParser(argparse.ArgumentParser):
+            def error(self, message):
+                raise QueryError(message)
+
+        start = time.time()
+        # keep both text and attributes so queries do not reformat or 
+        # reparse records
+        self.entries = [Record(e.cls, e.attrs, e.text()) for e in entries]
+        self.index = EntryIndex(self.entries)
+        self.jobs = jobs
+        logging.info("loaded %d entries in %s" % (len(self.entries), 
+            td(start, time.time())))
+        self.parser = QueryParser(prog="query", add_help=False,
+            description="search options, 'help' for this message and "
+            "'quit' to exit")
+        add_search_arguments(self.parser)
+
+    def query(self, line, output):
+        """ 
+        run single query line writing results to output.  Returns False when
+        the client asked to quit
+        """
+        start = time.time()
+        try:
+            argv = shlex.split(line)
+            if len(argv) == 0: return True
+            if argv[0] in ("quit", "exit"): return False
+            if argv[0] in ("help", "?"):
+                output.write(self.parser.format_help())
+            else:
+                args = self.parser.parse_args(argv)
+                # reject invalid patterns before the search starts
+                for pattern in (args.regex or []) + [args.sortr]:
+                    if pattern: re.compile(pattern)
+                run_query(self.entries, args, output, index=self.index,
+                    jobs=self.jobs)
+        except (QueryError, ValueError, re.error, IOError, OSError) as e:
+            output.write("error: %s" % e)
+        output.flush()
+        logging.debug("query time: %s" % td(start, time.time()))
+        return True
+
+    def repl(self, input_file=None, output=None):
+        """ answer queries read from input_file (stdin) until eof or quit """
+        if input_file is None: input_file = sys.stdin
+        if output is None: output = OutputWriter()
+        interactive = input_file.isatty() and sys.stdout.isatty()
+        try:
+            while True:
+                if interactive:
+                    try: line = input("> ")
+                    except EOFError: break
+                else:
+                    line = input_file.readline()
+                    if len(line) == 0: break
+                if not self.query(line, output): break
+        except (KeyboardInterrupt, OutputClosed):
+            pass
+
+    def serve(self, address):
+        """ answer queries from clients connecting to unix socket address """
+        import socketserver, io, signal
+        server = self
+
+        class QueryHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                stream = io.TextIOWrapper(self.wfile, encoding="utf-8")
+                output = OutputWriter(stream=stream)
+                try:
+                    server.query(self.rfile.readline().decode("utf-8"), 
+                        output)
+                except (OutputClosed, BrokenPipeError):
+                    logging.debug("client closed connection")
+
+        self._remove_stale(address)
+        listener = socketserver.UnixStreamServer(address, QueryHandler)
+        logging.info("serving queries on %s" % address)
+        # exit through finally on kill so the socket is removed
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+        try:
+            listener.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            listener.server_close()
+            os.unlink(address)
+
+    def _remove_stale(self, address):
+        """
+        remove socket left at address by a server that is no longer running.
+        Raises an exception if address is not a socket or is still in use
+        """
+        import socket
+        if not os.path.lexists(address): return
+        if not stat.S_ISSOCK(os.stat(address).st_mode):
+            raise Exception("%s exists and is not a socket" % address)
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(address)
+        except (ConnectionRefusedError, FileNotFoundError):
+            logging.debug("removing stale socket %s" % address)
+            os.unlink(address)
+            return
+        finally:
+            probe.close()
+        raise Exception("address in use: %s" % address)
 
 
 if __name__ == "__main__":
 
-    import argparse, sys, os
+    import argparse
 
     desc = """
     takes raw input from --file or piped from standard in.  Can also provide
@@ -617,22 +2543,33 @@ if __name__ == "__main__":
 
     """
     parser = argparse.ArgumentParser(description=desc)
-    parser.add_argument("-r", "--regex", action="store", dest="regex",
-        help="print all entries that match search regex")
-    parser.add_argument("--negative", action="store_true", dest="nregex",
-        help="print all entries that do not match search regex")
-    parser.add_argument("-i", "--ignore-case", action="store_true", 
-        dest="ignore_case", help="case insensitive search")
-    parser.add_argument("--sort", action="store", dest="sort",
-        help="sort results based on provided attribute")
-    parser.add_argument("--sortr", action="store", dest="sortr",
-        help="sort results based on value matched from provided regex")
+    add_search_arguments(parser)
+    parser.add_argument("--merge", action="store_true", dest="merge",
+        help="input files are already sorted on the --sort attribute "
+        "(default created), stream a merge of the files instead of sorting. "
+        "Output keeps the input order, see --input-order")
+    parser.add_argument("--input-order", action="store", dest="input_order",
+        choices=["asc", "desc"], help="order of records within each input "
+        "file, desc for order-by=<class>.created|desc (default for --merge)")
+    parser.add_argument("--dedup", action="store", dest="dedup", nargs="?",
+        const="dn", metavar="KEY", help="drop entries repeating the value "
+        "of attribute KEY (default dn, multiple attributes can be comma "
+        "separated) seen in an earlier entry, such as records repeated "
+        "across pages")
+    parser.add_argument("--follow", action="store", dest="follow",
+        metavar="STATEFILE", help="print only entries created after those "
+        "printed by the previous run with the same STATEFILE, which keeps "
+        "the newest printed created and id per class and the filters used."
+        "  With --input-order desc (or --merge), reading a file stops at "
+        "the entries already seen")
     parser.add_argument("--file", action="store", help="filename", 
         dest="file", nargs="+")
     parser.add_argument("--restore", action="store", help="saved output list",
         dest="restore")
     parser.add_argument("--dump", action="store_true", 
-        help="dump entries in json format", dest="dump")
+        help="dump entries in indexed binary snapshot format", dest="dump")
+    parser.add_argument("--dump-json", action="store_true", 
+        help="dump entries in (legacy) json format", dest="dump_json")
     parser.add_argument("--xml", action="store_true", 
         help="input in xml format", dest="xml")
     parser.add_argument("--json", action="store_true", 
@@ -647,16 +2584,27 @@ if __name__ == "__main__":
     parser.add_argument("--allow-empty", action="store_true", 
         dest="allow_empty",
         help="allow empty lines within a section")
-    parser.add_argument("--retro", action="store_true", dest="retro_option",
-        help="retro argument, will auto-detect aaa, fault, or event")
-    parser.add_argument("--space", action="store_true", dest="retro_space",
-        help="space argument for retro, adds a space after 5 seconds of inactivity")
-    parser.add_argument("--month", action="store_true", dest="retro_month",
-        help="converts the month from a number into a 3 letter abbreviation")
-    parser.add_argument("--full", action="store_true", dest="retro_full",
-        help="prints the full output, default is only 40 characters")
-    parser.add_argument("--deletion", action="store_true", dest="retro_deletion",
-        help="option to print faults that are in deletion state, which are suppressed by default")
+    parser.add_argument("--no-cache", action="store_true", dest="no_cache",
+        help="do not use or update the on-disk cache of parsed files")
+    parser.add_argument("--cache-dir", action="store", dest="cache_dir",
+        help="parse cache directory (default $SECTION_PARSER_CACHE or "
+        "~/.cache/section_parser)")
+    parser.add_argument("--cache-size", action="store", dest="cache_size",
+        type=int, default=1024, 
+        help="maximum size of the parse cache in MB (default 1024)")
+    parser.add_argument("--jobs", action="store", dest="jobs", type=int,
+        default=1, help="number of worker processes used to parse multiple "
+        "files in parallel and to search restored entries, 0 to use all "
+        "cores (default 1)")
+    parser.add_argument("--serve", action="store", dest="serve", nargs="?",
+        const="-", metavar="SOCKET", help="load entries once and answer "
+        "queries (search options such as '-r admin --retro', one per line) "
+        "read from stdin, or from clients connecting to unix SOCKET")
+    parser.add_argument("--output", action="store", dest="output",
+        help="write results to file instead of stdout")
+    parser.add_argument("--stats", action="store", dest="stats", nargs="?",
+        const="-", help="write per-phase timing, memory and counters as json"
+        " to stderr or to the provided file")
     parser.add_argument("--debug", action="store", help="debug level",
         dest="debug", default="ERROR")
 
@@ -665,7 +2613,7 @@ if __name__ == "__main__":
     # configure logging
     logger = logging.getLogger("")
     logger.setLevel(logging.WARN)
-    logger_handler = logging.StreamHandler(sys.stdout)
+    logger_handler = logging.StreamHandler(sys.stderr)
     fmt ="%(asctime)s.%(msecs).03d %(levelname)8s %(filename)"
     fmt+="16s:(%(lineno)d): %(message)s"
     logger_handler.setFormatter(logging.Formatter(
@@ -681,6 +2629,21 @@ if __name__ == "__main__":
     if args.debug == "WARN": logger.setLevel(logging.WARN)
     if args.debug == "ERROR": logger.setLevel(logging.ERROR)
 
+    stats.enabled = args.stats is not None
+
+    # --follow checkpoints the newest printed entry, queries print entries
+    # many times and limits leave older new entries unprinted
+    if args.follow is not None:
+        if args.serve is not None:
+            parser.error("--follow cannot be used with --serve")
+        if args.limit is not None or args.tail is not None:
+            parser.error("--follow cannot be used with --limit or --tail")
+
+    # report unreadable or empty pattern files before reading the input
+    if args.patterns_file is not None:
+        try: load_patterns(args.patterns_file)
+        except (ValueError, IOError, OSError) as e: parser.error("%s" % e)
+
 
     # determine whether to use xml or json pretty print method
     method = None
@@ -696,19 +2659,27 @@ if __name__ == "__main__":
     # since we're using try/finally to ensure correct file closure, we need a 
     # flag to indicate whether or not to proceed with dump/search
     sys_exited = False    
+    ifiles = []
+    follow = None
 
     try:
+        # only entries newer than the previous run are read with --follow
+        if args.follow is not None: 
+            follow = FollowState(args.follow, follow_query(args))
+
         # if restore option, use user provided file for input
         if args.restore is not None:
-            with open(args.restore, "r") as f:
+            with stats.phase("load"), open(args.restore, "rb") as f:
                 entries = restore_entries(f)
+            if follow is not None: entries = follow.iter_new(entries)
         else:
             # get data from file or stdin and write to output file or stdout
-            ifiles = []
             in_file = None
+            flist = []
+            jobs = 1
+            cache = None
             if args.file is not None:
                 # args.file is a list of files, need to check each one
-                flist = []
                 for af in args.file:
                     if os.path.isfile(af):
                         # grab specific file
@@ -719,14 +2690,24 @@ if __name__ == "__main__":
                             if os.path.isfile(os.path.join(af, df)):
                                 flist.append(os.path.join(af, df))
 
-                try:
-                    #in_file = open(args.file, "r")
-                    for af in flist:
-                        ifiles.append(open(af, "r"))
-                except:
-                    import traceback
-                    traceback.print_exc()
-                    sys.exit()
+                if args.jobs != 1 and len(flist) > 1:
+                    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+                # the cache key hashes each whole file before it is parsed,
+                # and partly read files are not cached.  Runs that stop 
+                # reading early (--follow, --since/--until on ordered 
+                # input, --limit without sort) skip it so their cost grows
+                # with the entries read, not with the file size
+                ordered = args.input_order is not None or args.merge
+                early_stop = args.follow is not None or (ordered and (
+                    args.since is not None or args.until is not None)) or (
+                    args.limit is not None and args.serve is None and 
+                    args.group_by is None and args.bucket is None and 
+                    not args.dump and not args.dump_json and 
+                    (args.merge or (args.sort is None and args.sortr is None)))
+                if not args.no_cache and not early_stop:
+                    cache = ParseCache(args.cache_dir, args.cache_size*1024*1024)
+                elif early_stop:
+                    logging.debug("parse cache skipped, input read partially")
             # no file was provided, try to read from stdin
             else: 
                 in_file = sys.stdin
@@ -736,18 +2717,65 @@ if __name__ == "__main__":
                 if in_file.isatty(): 
                     parser.print_help()
                     sys.exit()
+                in_file = open_stream(in_file)
+                ifiles = [in_file]
+                if args.serve == "-":
+                    raise Exception("--serve reads queries from stdin, "
+                        "provide input with --file or --restore")
 
             # support multiple files, parse each individually and append to 
-            # entries list
-            for f in ifiles:
-                # execute method
-                if method == "moquery": entries+= build_from_text(f)
-                elif method == "text": 
-                    entries+= build_from_text(f, args.delim, args.allow_empty)
-                elif method == "xml": entries+= build_from_xml(f)
-                elif method == "json": entries+= build_from_json(f)
+            # entries list.  When no sort or dump is requested, entries are
+            # streamed into the search as each file is parsed
+            if method not in ("moquery", "text", "xml", "json"):
+                raise Exception("invalid method: %s" % method)
+
+            # files ordered on created stop being read once their entries 
+            # are past the --since/--until window or reach the entries seen
+            # by the previous --follow run.  Snapshots are searched through
+            # their index instead
+            input_order = args.input_order
+            if args.merge and (args.sort or "created") == "created":
+                input_order = input_order or "desc"
+            def window(source):
+                if follow is not None:
+                    source = follow.iter_new(source, input_order)
+                if input_order is None or isinstance(source, Snapshot) or \
+                    (args.since is None and args.until is None):
+                    return source
+                return iter_time_window(source, args.since, args.until, 
+                    input_order)
+
+            stats.enter("load")
+            if args.merge:
+                if jobs != 1:
+                    sources = list(iter_parallel_files(flist, jobs, method, 
+                        args.delim, args.allow_empty, cache))
+                elif len(ifiles) > 0:
+                    sources = [iter_from_file(f, method, args.delim, 
+                        args.allow_empty) for f in ifiles]
                 else:
-                    raise Exception("invalid method: %s" % method)
+                    sources = [load_file(af, method, args.delim, 
+                        args.allow_empty, cache) for af in flist]
+                entries = iter_merged([window(s) for s in sources], 
+                    args.sort or "created", args.input_order or "desc")
+            elif jobs != 1:
+                entries = iter_parallel(flist, jobs, method, args.delim,
+                    args.allow_empty, cache)
+                if follow is not None: entries = follow.iter_new(entries)
+            elif len(ifiles) > 0:
+                entries = itertools.chain.from_iterable(
+                    window(iter_from_file(f, method, args.delim, 
+                    args.allow_empty)) for f in ifiles
+                )
+            elif len(flist) == 1:
+                entries = window(load_file(flist[0], method, args.delim, 
+                    args.allow_empty, cache))
+            else:
+                entries = itertools.chain.from_iterable(
+                    window(load_file(af, method, args.delim, 
+                    args.allow_empty, cache)) for af in flist
+                )
+            stats.exit()
 
     except SystemExit:
         # do nothing if sys.exit was manually called
@@ -757,34 +2785,73 @@ if __name__ == "__main__":
         traceback.print_exc() 
         sys_exited = True
     finally:
-        # try to close input and output files
-        # note, this can be closing stdin or stdout so don't attempt
-        # to read/write (i.e., 'print') after they are closed
-        try:
-            if in_file is not None: in_file.close()
-        except: pass
+        # try to close input files on failure.  Otherwise they are left open
+        # as entries may still be streamed from them during the search
+        # note, this can be closing stdin so don't attempt to read after
+        if sys_exited:
+            for f in ifiles:
+                try: f.close()
+                except: pass
 
     # force an exit if it was hit in the try/finally
     if sys_exited: sys.exit()
 
-    # build sort regex based on provided arguments
-    sortr = None
-    if args.sort is not None:
-        sortr = "%s[ \t]*:[ \t]*(?P<m>[^ \n]+)" % args.sort
-    elif args.sortr is not None:
-        sortr = "(?P<m>%s)" % args.sortr
+    # entries are built lazily (streamed or decoded from snapshots)
+    if isinstance(entries, Snapshot):
+        stats.count("entries", len(entries))
+    else:
+        entries = stats.iter("build", entries, "entries")
+    if args.dedup is not None:
+        entries = iter_dedup(entries, args.dedup)
 
     # dump entries if user requested it 
     # (for reuse of existing file with re-parsing each time)
-    if args.dump:
-        dump_entries(entries)
-
-    # execute search against entries and print WHOLE entry on match
-    elif args.regex:
-        search_entries(entries, args.regex, args.ignore_case, sortr,args.nregex, args.retro_option,
-        args.retro_space, args.retro_month, args.retro_full, args.retro_deletion)
-    # no regex provided - just print all entries with user's sort option
-    else:
-        search_entries(entries, None, None, sortr, args.nregex, args.retro_option, args.retro_space,
-        args.retro_month, args.retro_full, args.retro_deletion)
+    output = None
+    try:
+        # dumped entries are emitted for --follow
+        if follow is not None and (args.dump or args.dump_json):
+            entries = follow.iter_emitted(entries)
+        if args.dump_json:
+            with stats.phase("output"):
+                output = OutputWriter(args.output)
+                dump_entries(entries, output)
+                output.close()
+        elif args.dump:
+            with stats.phase("output"):
+                if args.output is None: dump_snapshot(entries)
+                else:
+                    with open(args.output, "wb") as f: dump_snapshot(entries, f)
+
+        # load entries once and answer queries against them
+        elif args.serve is not None:
+            server = QueryServer(entries, args.jobs)
+            if args.serve == "-": 
+                output = OutputWriter(args.output)
+                server.repl(output=output)
+                output.close()
+            else: server.serve(args.serve)
+
+        # execute search against entries and print WHOLE entry on match
+        # merged inputs are already sorted
+        else:
+            output = OutputWriter(args.output)
+            run_query(entries, args, output, presorted=args.merge, 
+                jobs=args.jobs, follow=follow)
+            output.close()
+
+        # checkpoint only once all new entries have been printed, entries
+        # are left unprinted when the reader goes away
+        if follow is not None and (output is None or not output.closed):
+            follow.save()
+    except (OutputClosed, BrokenPipeError):
+        # reader closed the pipe, stop quietly
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        os.close(devnull)
+
+    # close input files now that all entries have been consumed
+    for f in ifiles:
+        try: f.close()
+        except: pass
 
+    if args.stats is not None: stats.write(args.stats)
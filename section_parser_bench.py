@@ -0,0 +1,221 @@
+#!/usr/bin/python
+
+"""
+benchmark harness for section_parser
+
+generates synthetic aaaModLR, faultRecord, and eventRecord inputs in xml,
+json, and moquery text format and times the build, search, sort, and retro
+stages against them.  Each benchmark runs in its own process so the peak
+RSS reported is for that benchmark only.  Results are written as one json
+object per line so runs from different versions can be compared
+
+Ex:
+
+    python3 section_parser_bench.py --sizes 10000,100000 > bench_output.txt
+"""
+
+import logging, json, time, os, sys, random, resource, tempfile, hashlib
+import platform
+import multiprocessing
+from xml.sax.saxutils import quoteattr
+
+import section_parser as sp
+
+CLASSES = ("aaaModLR", "faultRecord", "eventRecord")
+FORMATS = ("xml", "json", "text")
+CASES = ("build", "search_regex", "search_negative", "search_sort", "retro")
+
+def generate_records(cls, count, seed=0):
+    """
+    yield (class, attributes) tuples for count synthetic records of class
+    cls, ordered by created desc as collected by icurl with order-by
+    """
+    rand = random.Random(seed)
+    created = 1590760245.0
+    users = ("admin", "remote_user-ops", "remote_user-netadmin")
+    codes = ("E4212025", "E4212026", "F0532", "F1394", "F0467", "E4205126")
+    severities = ("info", "warning", "minor", "major", "critical", "cleared")
+    for i in range(count):
+        # bursts of sub-second changes separated by gaps
+        created-= rand.choice((0.001, 0.01, 0.2, 3, 45, 600))
+        ts = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(created))
+        ts+= ".%03d+00:00" % (int(created*1000) % 1000)
+        tn = "tn-%s" % rand.choice(("A", "B", "common", "prod", "dev"))
+        affected = "uni/%s/ap-AP%d/epg-EPG_%d/rspathAtt-[topology/pod-1/"\
+            "paths-%d/pathep-[eth1/%d]]" % (tn, rand.randint(1, 5),
+            rand.randint(1, 300), rand.randint(101, 120), rand.randint(1, 48))
+        rid = 4294967296 + count - i
+        ind = rand.choice(("creation", "modification", "deletion"))
+        attrs = {
+            "affected": affected,
+            "cause": rand.choice(("transition", "config-change", "resolution")),
+            "changeSet": rand.choice(("", "", "encap:vlan-%d, instrImedcy:"
+                "immediate, mode:regular" % rand.randint(1, 4000))),
+            "childAction": "",
+            "code": rand.choice(codes),
+            "created": ts,
+            "descr": "RsPathAtt topology/pod-1/paths-%d %s" % (
+                rand.randint(101, 120), ind),
+            "dn": "subj-[%s]/%s-%d" % (affected,
+                "mod" if cls == "aaaModLR" else "rec", rid),
+            "id": str(rid),
+            "ind": ind,
+            "modTs": "never",
+            "severity": rand.choice(severities),
+            "status": "",
+            "trig": rand.choice(("config", "oper")),
+        }
+        if cls == "aaaModLR":
+            attrs["sessionId"] = "%016x" % rand.getrandbits(64)
+            attrs["txId"] = str(5765202 + i)
+            attrs["user"] = rand.choice(users)
+        elif cls == "faultRecord":
+            attrs["lc"] = rand.choice(("raised", "soaking", "retaining"))
+            attrs["origSeverity"] = rand.choice(severities)
+            attrs["highestSeverity"] = rand.choice(severities)
+            attrs["occur"] = str(rand.randint(1, 10))
+        else:
+            attrs["user"] = rand.choice(users)
+        yield cls, dict(sorted(attrs.items()))
+
+def write_input(path, cls, count, fmt, seed=0):
+    """ write count synthetic records of class cls to path in format fmt """
+    records = generate_records(cls, count, seed)
+    with open(path, "w") as f:
+        if fmt == "xml":
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+            f.write('<imdata totalCount="%d">' % count)
+            for c, attrs in records:
+                f.write("<%s %s/>" % (c, " ".join("%s=%s" % (
+                    a, quoteattr(attrs[a])) for a in attrs)))
+            f.write("</imdata>\n")
+        elif fmt == "json":
+            f.write('{"totalCount":"%d","imdata":[' % count)
+            for i, (c, attrs) in enumerate(records):
+                if i > 0: f.write(",")
+                f.write(json.dumps({c: {"attributes": attrs}}))
+            f.write("]}\n")
+        else:
+            for c, attrs in records:
+                f.write("# %s\n" % c)
+                for a in attrs:
+                    f.write("{0:<16}: {1}\n".format(a, attrs[a]))
+                f.write("\n")
+
+def build(path, fmt):
+    """ build entries list from path """
+    method = "moquery" if fmt == "text" else fmt
+    return sp.parse_file(path, method)
+
+def run_case(case, path, fmt):
+    """
+    run single benchmark case and return (seconds, records processed).
+    Only the measured stage is timed, inputs are built beforehand
+    """
+    if case == "build":
+        start = time.time()
+        entries = build(path, fmt)
+        return time.time() - start, len(entries)
+
+    entries = build(path, fmt)
+    start = time.time()
+    if case == "search_regex":
+        sp.search_entries(entries, "tn-prod/ap-AP1")
+    elif case == "search_negative":
+        sp.search_entries(entries, "tn-prod/ap-AP1", sort_neg=True)
+    elif case == "search_sort":
+        sp.search_entries(entries, None, sort_attr="created")
+    elif case == "retro":
+        for line in sp.retro_entry_parse(entries, False, True): pass
+    else:
+        raise Exception("invalid case: %s" % case)
+    return time.time() - start, len(entries)
+
+def __case_worker(queue, case, path, fmt):
+    """ child process running a single case, reports result via queue """
+    sys.stdout = open(os.devnull, "w")
+    try:
+        seconds, records = run_case(case, path, fmt)
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in KB elsewhere
+        if sys.platform != "darwin": rss*= 1024
+        queue.put({"seconds": seconds, "records": records, "peak_rss": rss})
+    except Exception as e:
+        queue.put({"error": "%s" % e})
+
+def benchmark(case, path, fmt):
+    """ run case in a separate process and return its result dict """
+    queue = multiprocessing.Queue()
+    p = multiprocessing.Process(target=__case_worker,
+        args=(queue, case, path, fmt))
+    p.start()
+    result = queue.get()
+    p.join()
+    return result
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description="benchmark section_parser")
+    parser.add_argument("--sizes", action="store", dest="sizes",
+        default="10000,100000,1000000",
+        help="comma separated record counts (default 10000,100000,1000000)")
+    parser.add_argument("--classes", action="store", dest="classes",
+        default=",".join(CLASSES), help="comma separated record classes")
+    parser.add_argument("--formats", action="store", dest="formats",
+        default=",".join(FORMATS), help="comma separated input formats")
+    parser.add_argument("--cases", action="store", dest="cases",
+        default=",".join(CASES), help="comma separated benchmark cases")
+    parser.add_argument("--dir", action="store", dest="dir",
+        help="directory for generated inputs, reused if present (default "
+        "is a temporary directory removed at exit)")
+    parser.add_argument("--output", action="store", dest="output",
+        help="write results to file instead of stdout")
+    parser.add_argument("--debug", action="store", help="debug level",
+        dest="debug", default="ERROR")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.debug.upper(),
+        logging.ERROR), stream=sys.stderr)
+
+    tmp = None
+    if args.dir is None:
+        tmp = tempfile.TemporaryDirectory(prefix="section_parser_bench")
+        args.dir = tmp.name
+    elif not os.path.isdir(args.dir):
+        os.makedirs(args.dir)
+
+    # identify the version being measured so results can be compared
+    with open(sp.__file__, "rb") as f:
+        version = hashlib.sha1(f.read()).hexdigest()[:12]
+
+    output = sys.stdout if args.output is None else open(args.output, "w")
+    try:
+        for size in [int(s) for s in args.sizes.split(",")]:
+            for cls in args.classes.split(","):
+                for fmt in args.formats.split(","):
+                    path = os.path.join(args.dir, "%s_%d.%s" % (cls, size,
+                        "txt" if fmt == "text" else fmt))
+                    if not os.path.isfile(path):
+                        logging.info("generating %s" % path)
+                        write_input(path, cls, size, fmt)
+                    for case in args.cases.split(","):
+                        result = benchmark(case, path, fmt)
+                        result.update({"case": case, "class": cls,
+                            "format": fmt, "size": size,
+                            "input_bytes": os.path.getsize(path),
+                            "version": version, 
+                            "python": platform.python_version()})
+                        if "seconds" in result and result["seconds"] > 0:
+                            result["records_per_sec"] = round(
+                                result["records"] / result["seconds"], 1)
+                            if case == "build":
+                                result["mb_per_sec"] = round(
+                                    result["input_bytes"] / 1048576.0 /
+                                    result["seconds"], 3)
+                        output.write(json.dumps(result, sort_keys=True)+"\n")
+                        output.flush()
+    finally:
+        if args.output is not None: output.close()
+        if tmp is not None: tmp.cleanup()